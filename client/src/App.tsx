@@ -6,6 +6,10 @@ import ChatBox from './components/ChatBox';
 import TranscriptionBox from './components/TranscriptionBox';
 import EmotionWheel from './components/EmotionWheel';
 import fetchTool from './utils/fetchData';
+import { encodeAudio, AudioFormat } from './utils/audioCodec';
+
+// Audio wire format asked for on start, the server answers with the one it accepted.
+const PREFERRED_AUDIO_FORMAT: AudioFormat = 'int16';
 
 function App() {
 
@@ -18,6 +22,8 @@ function App() {
   const [emotions, setEmotions] = useState<any[]>([]);
   const [waitingForResponse, setWaitingForResponse] = useState<boolean>(false);
   const [fullText, setFullText] = useState<string>("");
+  const [queuePosition, setQueuePosition] = useState<number>(0);
+  const [interim, setInterim] = useState<string>("");
   const [leftWidth, setLeftWidth] = useState<number>(50);
   const [folders, setFolders] = useState<any[]>([]);
 
@@ -33,6 +39,7 @@ function App() {
   const vidRef = useRef<HTMLVideoElement | null>(null);
   const timeRef = useRef<string>("");
   const isResizing = useRef<boolean>(false);
+  const audioFormat = useRef<AudioFormat | null>(null);
 
   const useEventListener = (eventName : any, handler : any, element = window) => {
     
@@ -138,6 +145,16 @@ function App() {
       }
     })
 
+    // Unconfirmed hypothesis of the words being spoken, sent as the tail replacing everything after its first `keep` characters.
+    socket.on("audio_interim", (data : any) => {
+      setInterim(prev => prev.slice(0, data["keep"]) + data["text"]);
+    })
+
+    // Place of the pending answer in the server's LLM queue, 0 once generation starts.
+    socket.on("chat_queue", (data : any) => {
+      setQueuePosition(data["position"]);
+    })
+
     socket.on("chat_response", (data : any) => {
       setFullText(prev => prev + data["message"]);
       fullTextRef.current += data["message"];
@@ -146,6 +163,7 @@ function App() {
 
     socket.on("stream_end", (data : any) => {
       setWaitingForResponse(false);
+      setQueuePosition(0);
       const temp = fullTextRef.current;
       const tempTime = fullTextTimeRef.current;
 
@@ -184,6 +202,8 @@ function App() {
       socket.off("connect");
       socket.off("disconnect");
       socket.off("audio_ans");
+      socket.off("audio_interim");
+      socket.off("chat_queue");
       socket.off("chat_response");
       socket.off("stream_end");
       socket.off("face_recognition_ans");
@@ -198,6 +218,7 @@ function App() {
 
     // Reset states when title is set
     setTranscription([]);
+    setInterim("");
     setMessages([]);
     setFullText("");
     fullTextRef.current = "";
@@ -270,7 +291,17 @@ function App() {
     input.current?.connect(processor.current);
     processor.current?.connect(audioCtx.current.destination);
     setIsRecording(true);
-    socket.emit("start")
+
+    // Audio is only sent once the server has acknowledged the format it will decode.
+    audioFormat.current = null;
+    // The server holds the acknowledgement while its models load, and refuses with an error if they aren't ready in time.
+    socket.emit("start", { format: PREFERRED_AUDIO_FORMAT }, (ack: any) => {
+      if (ack?.error) {
+        alert(ack.error);
+        return;
+      }
+      audioFormat.current = ack?.format ?? 'float32';
+    });
   }
 
   const stopRecording = () => {
@@ -280,12 +311,16 @@ function App() {
     stream.current?.getTracks().forEach(track => track.stop());
 
     socket.emit("stop")
+    audioFormat.current = null;
+    setInterim("");
 
     setIsRecording(false);
   }
 
-  function sendChunkToServer(int16Chunk : any) {
-    const blob = new Blob([int16Chunk], { type: 'application/octet-stream' });
+  function sendChunkToServer(chunk : Float32Array) {
+    if (!audioFormat.current) return;
+
+    const blob = new Blob([encodeAudio(chunk, audioFormat.current)], { type: 'application/octet-stream' });
     socket.emit("audio", {
       "audio_data": blob,
     });
@@ -305,9 +340,8 @@ function App() {
     }
 
     setMessages([...messages, {type: "User", content: message, time: getCurrentTime()}]);
-    socket.emit("chat_message", { message, title, transcription: transcription.map((obj) => {
-      return `${obj.time} ${obj.text}`;
-    }).join("\n"), history: messages.slice(-10), "emotions": emotions.slice(-30) });
+    // The server keeps the transcript, emotions and chat history of the session, only the question is sent.
+    socket.emit("chat_message", { message });
     setMessage("");
     setWaitingForResponse(true);
   }
@@ -367,7 +401,7 @@ function App() {
 
           <div style={{ display: "flex", flexDirection: "column", alignItems: "center", justifyContent: "center", width: `${leftWidth}%` }}>
             <h3>Chatbox</h3>
-            <ChatBox messages={messages} temp={fullText} temptime={fullTextTimeRef.current} />
+            <ChatBox messages={messages} temp={fullText || (waitingForResponse && queuePosition > 0 ? `_Waiting for the assistant, position ${queuePosition} in line..._` : "")} temptime={fullTextTimeRef.current} />
             <div style={{width: "100%", position: "relative", display: "flex", flexDirection: "row", alignItems: "center", justifyContent: "space-between"}}>
               <textarea rows={1} placeholder='Ask MedGemma...' className='input-text' onKeyDown={(e) => {
                 if (e.key === "Enter") {
@@ -398,7 +432,7 @@ function App() {
           </div>
           <div style={{ display: "flex", flexDirection: "column", alignItems: "flex-start", textAlign: "left", width: `${100 - leftWidth}%`, margin: 0 }}>
             <h3 style={{width: "100%", textAlign: "center"}}>Transcription</h3>
-            <TranscriptionBox messages={transcription} />
+            <TranscriptionBox messages={transcription} interim={interim} />
           </div>
         </div>
         
@@ -10,8 +10,9 @@ const TranscriptionBox = (props: any) => {
         <div style={{ width: "100%"}} className='transcription-box-container'>
             <div className="timeline-messages-container"> 
                 {props.messages.map((msg : any, index : number) => (
-                    <TimeBlock key={index} message={msg} isLast={index === props.messages.length -1}/>
+                    <TimeBlock key={index} message={msg} isLast={index === props.messages.length -1 && !props.interim}/>
                 ))}
+                {props.interim && <TimeBlock message={{ time: "", text: props.interim }} isLast={true} interim={true}/>}
                 <div ref={end} className="timeline-messages-end"></div>
             </div>
             <button onClick={() => {
@@ -24,7 +25,7 @@ const TranscriptionBox = (props: any) => {
 
 }
 
-const TimeBlock = ({ message, isLast } : any) => {
+const TimeBlock = ({ message, isLast, interim } : any) => {
     return (
         <div className="message-item">
             <div className="message-item__timestamp"> 
@@ -37,7 +38,7 @@ const TimeBlock = ({ message, isLast } : any) => {
             </div>
 
             <div className="message-item__content-box">
-                <p className="message-item__text">{message.text}</p>
+                <p className={interim ? "message-item__text message-item__text--interim" : "message-item__text"}>{message.text}</p>
             </div>
         </div>
     )
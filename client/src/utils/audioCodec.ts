@@ -0,0 +1,47 @@
+// Compact wire formats for the audio events, the server decodes them back to float32 PCM.
+// int16 halves and mu-law quarters the 64 KB/s of raw float32 audio.
+
+export type AudioFormat = 'float32' | 'int16' | 'mulaw';
+
+const MULAW_BIAS = 0x84;
+const MULAW_CLIP = 32635;
+
+const toInt16 = (sample: number) => {
+  const clamped = Math.max(-1, Math.min(1, sample));
+  return clamped < 0 ? clamped * 0x8000 : clamped * 0x7fff;
+}
+
+export const encodeInt16 = (samples: Float32Array): ArrayBuffer => {
+  const out = new Int16Array(samples.length);
+  for (let i = 0; i < samples.length; i++) {
+    out[i] = toInt16(samples[i]);
+  }
+  return out.buffer;
+}
+
+const linearToMulaw = (sample: number) => {
+  const sign = sample < 0 ? 0x80 : 0;
+  let magnitude = Math.min(Math.abs(sample), MULAW_CLIP) + MULAW_BIAS;
+
+  let exponent = 7;
+  for (let mask = 0x4000; (magnitude & mask) === 0 && exponent > 0; mask >>= 1) {
+    exponent--;
+  }
+  const mantissa = (magnitude >> (exponent + 3)) & 0x0f;
+
+  return ~(sign | (exponent << 4) | mantissa) & 0xff;
+}
+
+export const encodeMulaw = (samples: Float32Array): ArrayBuffer => {
+  const out = new Uint8Array(samples.length);
+  for (let i = 0; i < samples.length; i++) {
+    out[i] = linearToMulaw(Math.round(toInt16(samples[i])));
+  }
+  return out.buffer;
+}
+
+export const encodeAudio = (samples: Float32Array, format: AudioFormat): ArrayBuffer | Float32Array => {
+  if (format === 'int16') return encodeInt16(samples);
+  if (format === 'mulaw') return encodeMulaw(samples);
+  return samples;
+}
@@ -0,0 +1,80 @@
+"""
+Stand-in for the REDCap API, so the server can be benchmarked offline.
+Point the server at it with REDCAP_URL=http://localhost:<port>/api/.
+
+    python -m bench.fake_redcap --port 5001 --records 100 --latency 50
+"""
+import argparse
+import asyncio
+import random
+
+import uvicorn
+from quart import Quart, jsonify, request
+
+app = Quart(__name__)
+
+# Set from the command line.
+RECORDS = {}
+LATENCY = 0.0
+
+
+def make_record(record_id):
+    """A completed screening and previsit record with plausible answers."""
+    rng = random.Random(record_id)
+    return {
+        "record_id": str(record_id),
+        "r_gi": str(rng.randint(1, 2)),
+        "r_age": str(rng.randint(1, 5)),
+        f"r_r___{rng.randint(1, 7)}": "1",
+        "r_e": str(rng.randint(0, 1)),
+        "r_t": str(rng.randint(1, 5)),
+        "r_pc": "1",
+        f"r_mp___{rng.randint(1, 6)}": "1",
+        "r_n": str(rng.randint(1, 3)),
+        "r_a": str(rng.randint(1, 5)),
+        "r_de": str(rng.randint(0, 7)),
+        "r_eal": str(rng.choice([0, 15, 30, 60])),
+        "r_f": str(rng.randint(0, 5)),
+        "r_v": str(rng.randint(0, 5)),
+        "screening_complete": "2",
+        "patient_previsit_complete": "2",
+    }
+
+
+@app.route("/api/", methods=["POST"])
+async def api():
+    form = await request.form
+    await asyncio.sleep(LATENCY * random.uniform(0.5, 1.5))
+
+    content = form.get("content")
+    if content == "record":
+        # httpx encodes a list field as repeated keys, REDCap's own clients send records[0], records[1], ...
+        wanted = form.getlist("records") + [v for k, v in form.items() if k.startswith("records[")]
+        records = [RECORDS[r] for r in wanted if r in RECORDS] if wanted else list(RECORDS.values())
+        return jsonify(records)
+    if content == "fileRepository":
+        action = form.get("action")
+        if action == "list":
+            return jsonify([])
+        if action == "createFolder":
+            return jsonify([{"folder_id": random.randint(1, 10 ** 6)}])
+        return jsonify({})
+    return jsonify({"error": f"Unsupported content {content}"}), 400
+
+
+def main():
+    global LATENCY
+
+    parser = argparse.ArgumentParser(description="Fake REDCap API for offline benchmarks.")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--records", type=int, default=100, help="Number of records, with IDs 1..N.")
+    parser.add_argument("--latency", type=float, default=50, help="Mean response latency in milliseconds.")
+    args = parser.parse_args()
+
+    LATENCY = args.latency / 1000
+    RECORDS.update({str(i): make_record(i) for i in range(1, args.records + 1)})
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+"""
+Load generator for the socket.io server: N synthetic visits, each behaving like the web client.
+
+Every client names its session after a record, starts recording, replays a WAV in real time as int16 audio events
+(4096-sample chunks, like the browser's ScriptProcessor), sends a webcam JPEG every 15 s, a video chunk every second and
+a chat message every --chat-interval seconds. The report gives end-to-end transcript and interim hypothesis latency,
+emotion latency, LLM time to first token and the dropped or late events.
+
+Offline run on CPU, with a tiny Whisper, the fake LLM and the fake REDCap started by the harness:
+
+    python -m bench.loadgen --spawn --clients 8 --duration 120 --wav speech.wav
+
+Models must already be in the Hugging Face cache, the spawned server runs with HF_HUB_OFFLINE=1.
+Against a running server:
+
+    python -m bench.loadgen --url http://localhost:5000 --clients 8 --duration 120 --wav speech.wav
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+import wave
+from collections import defaultdict
+
+import httpx
+import numpy as np
+import socketio
+
+SAMPLE_RATE = 16000
+CHUNK_SAMPLES = 4096
+
+CHAT_QUESTIONS = [
+    "What should I ask the patient next?",
+    "Summarize the patient's main complaint.",
+    "Are there any red flags in what the patient said?",
+    "What follow-up tests would you recommend?",
+]
+
+
+def load_wav(path):
+    """Read a WAV file as float32 mono 16 kHz, resampling linearly if needed."""
+    with wave.open(path, "rb") as f:
+        channels, width, rate = f.getnchannels(), f.getsampwidth(), f.getframerate()
+        frames = f.readframes(f.getnframes())
+
+    if width != 2:
+        raise ValueError(f"{path}: only 16-bit PCM WAV files are supported")
+    audio = np.frombuffer(frames, dtype="<i2").astype(np.float32) / 32768
+    audio = audio.reshape(-1, channels).mean(axis=1)
+    if rate != SAMPLE_RATE:
+        positions = np.arange(0, len(audio), rate / SAMPLE_RATE)
+        audio = np.interp(positions, np.arange(len(audio)), audio).astype(np.float32)
+    return audio
+
+
+def load_image(path=None):
+    """JPEG bytes of the given image, or of a synthetic 640x480 webcam frame."""
+    if path:
+        with open(path, "rb") as f:
+            return f.read()
+
+    from PIL import Image
+
+    y, x = np.mgrid[0:480, 0:640]
+    frame = np.stack([(x * 255 // 640), (y * 255 // 480), np.full_like(x, 128)], axis=-1).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(frame).save(buffer, format="JPEG", quality=95)
+    return buffer.getvalue()
+
+
+class Report:
+    """Latency samples and event counters collected from all clients."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.counters = defaultdict(float)
+
+    def observe(self, name, value):
+        self.samples[name].append(value)
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def summary(self):
+        latencies = {}
+        for name, values in self.samples.items():
+            values = np.asarray(values)
+            latencies[name] = {
+                "count": len(values),
+                "p50": float(np.percentile(values, 50)),
+                "p95": float(np.percentile(values, 95)),
+                "p99": float(np.percentile(values, 99)),
+                "max": float(values.max()),
+            }
+        return {"latency_seconds": latencies, "events": dict(self.counters)}
+
+    def print(self):
+        summary = self.summary()
+        print(f"\n{'latency (s)':<28}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+        for name, s in sorted(summary["latency_seconds"].items()):
+            print(f"{name:<28}{s['count']:>8}{s['p50']:>10.3f}{s['p95']:>10.3f}{s['p99']:>10.3f}{s['max']:>10.3f}")
+        print(f"\n{'events':<28}{'count':>8}")
+        for name, value in sorted(summary["events"].items()):
+            print(f"{name:<28}{value:>8g}")
+
+
+class SyntheticClient:
+    """
+    One synthetic visit. Audio, face frames, video chunks and chat messages are sent on their own schedules, like the web client.
+    Args:
+        index (int): Client number, also picks the record the session is named after.
+        args (argparse.Namespace): Harness options.
+        audio (np.ndarray): float32 16 kHz audio to replay, looped for the whole run.
+        image (bytes): JPEG sent as the webcam frame.
+        report (Report): Where the measurements go.
+    """
+
+    def __init__(self, index, args, audio, image, report):
+        self.index = index
+        self.args = args
+        self.audio = audio
+        self.image = image
+        self.report = report
+        self.record = str(index % args.records + 1)
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.recording_started = None
+        self.chat_sent = None
+        self.chat_first_token = None
+        self.chat_done = None
+
+        self.sio.on("audio_ans", self.on_audio_ans)
+        self.sio.on("audio_interim", self.on_audio_interim)
+        self.sio.on("chat_response", self.on_chat_response)
+        self.sio.on("stream_end", self.on_stream_end)
+        self.sio.on("error", self.on_error)
+
+    async def on_audio_ans(self, data):
+        self.report.count("transcripts")
+        if data.get("end") is None or self.recording_started is None:
+            return
+        # The audio ending at `end` was sent at recording_started + end, the rest is server-side latency.
+        latency = time.monotonic() - (self.recording_started + data["end"])
+        self.report.observe("transcript", latency)
+        if latency > self.args.late_threshold:
+            self.report.count("transcripts_late")
+
+    async def on_audio_interim(self, data):
+        self.report.count("interims")
+        if data.get("end") is None or self.recording_started is None:
+            return
+        # Same measure for the unconfirmed hypothesis, the latency clinicians actually perceive.
+        self.report.observe("interim", time.monotonic() - (self.recording_started + data["end"]))
+
+    async def on_chat_response(self, data):
+        if self.chat_sent is not None and self.chat_first_token is None:
+            self.chat_first_token = time.monotonic()
+            self.report.observe("chat_ttft", self.chat_first_token - self.chat_sent)
+
+    async def on_stream_end(self, data):
+        if self.chat_sent is not None:
+            self.report.observe("chat_total", time.monotonic() - self.chat_sent)
+        if data.get("message") != "END":
+            self.report.count("chat_interrupted")
+        if self.chat_done:
+            self.chat_done.set()
+
+    async def on_error(self, data):
+        self.report.count("server_errors")
+        if self.args.verbose:
+            print(f"client {self.index}: error {data}")
+
+    async def run(self, deadline):
+        try:
+            await self.sio.connect(self.args.url, transports=["websocket"])
+        except Exception as e:
+            print(f"client {self.index}: failed to connect: {e}")
+            self.report.count("connect_failures")
+            return
+
+        try:
+            await self.sio.emit("session_name", {"session_name": self.record})
+            ack = await self.sio.call("start", {"format": "int16"}, timeout=30)
+            if (ack or {}).get("format") != "int16":
+                raise RuntimeError(f"server did not accept int16 audio: {ack}")
+            self.recording_started = time.monotonic()
+
+            tasks = [
+                asyncio.ensure_future(self.send_audio(deadline)),
+                asyncio.ensure_future(self.send_faces(deadline)),
+                asyncio.ensure_future(self.send_video(deadline)),
+                asyncio.ensure_future(self.send_chats(deadline)),
+            ]
+            await asyncio.gather(*tasks)
+            await self.collect_server_stats()
+            await self.sio.emit("stop")
+        except Exception as e:
+            print(f"client {self.index}: {e}")
+            self.report.count("client_failures")
+        finally:
+            await self.sio.disconnect()
+
+    async def sleep_until(self, t):
+        delay = t - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def send_audio(self, deadline):
+        chunk_seconds = CHUNK_SAMPLES / SAMPLE_RATE
+        position = 0
+        k = 0
+        while True:
+            due = self.recording_started + k * chunk_seconds
+            if due >= deadline:
+                return
+            await self.sleep_until(due)
+            # A client that can't keep real time skews every other measurement, count it so an overloaded harness shows.
+            if time.monotonic() - due > 0.1:
+                self.report.count("audio_sends_late")
+
+            chunk = np.take(self.audio, range(position, position + CHUNK_SAMPLES), mode="wrap")
+            position = (position + CHUNK_SAMPLES) % len(self.audio)
+            pcm = (np.clip(chunk, -1, 1) * 32767).astype("<i2").tobytes()
+            await self.sio.emit("audio", {"audio_data": pcm})
+            self.report.count("audio_chunks")
+            k += 1
+
+    async def send_faces(self, deadline):
+        # The web client sends its first frame one interval after recording starts.
+        due = self.recording_started + self.args.face_interval
+        while due < deadline:
+            await self.sleep_until(due)
+            start = time.monotonic()
+            try:
+                # The handler only returns after emitting its answer, so the ack time is the emotion latency.
+                await self.sio.call("face_recognition", {"image_data": self.image}, timeout=self.args.face_interval)
+                latency = time.monotonic() - start
+                self.report.observe("emotion", latency)
+                if latency > self.args.late_threshold:
+                    self.report.count("emotions_late")
+            except socketio.exceptions.TimeoutError:
+                self.report.count("emotions_dropped")
+            due += self.args.face_interval
+
+    async def send_video(self, deadline):
+        chunk = os.urandom(self.args.video_bytes)
+        due = self.recording_started + self.args.video_interval
+        while due < deadline:
+            await self.sleep_until(due)
+            await self.sio.emit("video", {"video_data": chunk})
+            self.report.count("video_chunks")
+            due += self.args.video_interval
+
+    async def send_chats(self, deadline):
+        if self.args.chat_interval <= 0:
+            return
+        due = self.recording_started + self.args.chat_interval
+        n = 0
+        while due < deadline:
+            await self.sleep_until(due)
+            question = CHAT_QUESTIONS[(self.index + n) % len(CHAT_QUESTIONS)]
+            self.chat_sent = time.monotonic()
+            self.chat_first_token = None
+            self.chat_done = asyncio.Event()
+            await self.sio.emit("chat_message", {"message": question})
+            self.report.count("chat_messages")
+            try:
+                await asyncio.wait_for(self.chat_done.wait(), self.args.chat_timeout)
+            except asyncio.TimeoutError:
+                self.report.count("chat_dropped")
+                await self.sio.emit("stop_chat")
+            n += 1
+            due = max(due + self.args.chat_interval, time.monotonic())
+
+    async def collect_server_stats(self):
+        """Audio the server dropped for this session because transcription fell behind."""
+        try:
+            async with httpx.AsyncClient(timeout=10) as http:
+                stats = (await http.get(f"{self.args.url}/api/sessions")).json()
+            audio = stats["sessions"].get(self.sio.get_sid(), {}).get("audio") or {}
+            self.report.count("server_audio_dropped_seconds", audio.get("dropped_seconds", 0))
+        except Exception as e:
+            if self.args.verbose:
+                print(f"client {self.index}: could not read session stats: {e}")
+
+
+def spawn_server(args):
+    """Start the fake REDCap and the server with offline stand-ins, returns the processes."""
+    server_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(
+        os.environ,
+        LLM_BACKEND="fake",
+        REDCAP_URL=f"http://127.0.0.1:{args.redcap_port}/api/",
+        REDCAP="bench",
+        CUDA_VISIBLE_DEVICES="",
+        HF_HUB_OFFLINE="1",
+    )
+    redcap = subprocess.Popen([sys.executable, "-m", "bench.fake_redcap", "--port", str(args.redcap_port),
+                               "--records", str(args.records), "--latency", str(args.redcap_latency)], cwd=server_dir, env=env)
+    server = subprocess.Popen([sys.executable, "main.py", "--port", str(args.port), "--model", args.asr_model,
+                               *args.server_args], cwd=server_dir, env=env)
+    return [redcap, server]
+
+
+async def wait_ready(url, timeout):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=5) as http:
+        while time.monotonic() < deadline:
+            try:
+                if (await http.get(f"{url}/api/ready")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(1)
+    raise TimeoutError(f"Server at {url} not ready after {timeout}s")
+
+
+async def run(args):
+    audio = load_wav(args.wav)
+    image = load_image(args.face_image)
+    report = Report()
+
+    await wait_ready(args.url, args.ready_timeout)
+
+    start = time.monotonic()
+    deadline = start + args.ramp * (args.clients - 1) + args.duration
+    clients = [SyntheticClient(i, args, audio, image, report) for i in range(args.clients)]
+
+    async def staggered(client):
+        await asyncio.sleep(client.index * args.ramp)
+        await client.run(deadline)
+
+    await asyncio.gather(*(staggered(client) for client in clients))
+    print(f"\n{args.clients} clients, {time.monotonic() - start:.0f}s")
+    report.print()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"clients": args.clients, "duration": args.duration, **report.summary()}, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run synthetic visits against the socket.io server and report latencies.")
+    parser.add_argument("--url", type=str, default=None, help="Server URL, defaults to the spawned server.")
+    parser.add_argument("--clients", type=int, default=4, help="Number of concurrent visits.")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds each visit records.")
+    parser.add_argument("--ramp", type=float, default=1, help="Seconds between the starts of two visits.")
+    parser.add_argument("--wav", type=str, required=True, help="Speech to replay, 16-bit PCM WAV, looped.")
+    parser.add_argument("--face-image", type=str, default=None, help="JPEG sent as the webcam frame, a synthetic frame by default.")
+    parser.add_argument("--face-interval", type=float, default=15, help="Seconds between webcam frames.")
+    parser.add_argument("--video-interval", type=float, default=1, help="Seconds between video chunks.")
+    parser.add_argument("--video-bytes", type=int, default=125_000, help="Size of each video chunk.")
+    parser.add_argument("--chat-interval", type=float, default=45, help="Seconds between chat messages, 0 disables chat.")
+    parser.add_argument("--chat-timeout", type=float, default=120, help="Seconds to wait for an answer before counting it as dropped.")
+    parser.add_argument("--late-threshold", type=float, default=5, help="Transcript or emotion latency in seconds above which an event counts as late.")
+    parser.add_argument("--records", type=int, default=100, help="Number of REDCap records the visits are spread over.")
+    parser.add_argument("--json", type=str, default=None, help="Also write the report to this JSON file.")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--spawn", action="store_true", help="Start the server and a fake REDCap offline on CPU with a fake LLM.")
+    parser.add_argument("--port", type=int, default=5000, help="Port of the spawned server.")
+    parser.add_argument("--redcap-port", type=int, default=5001, help="Port of the spawned fake REDCap.")
+    parser.add_argument("--redcap-latency", type=float, default=50, help="Mean latency of the fake REDCap in milliseconds.")
+    parser.add_argument("--asr-model", type=str, default="tiny", help="Whisper model of the spawned server.")
+    parser.add_argument("--ready-timeout", type=float, default=600, help="Seconds to wait for the server to load its models.")
+    parser.add_argument("server_args", nargs=argparse.REMAINDER, help="Extra arguments for the spawned server, after --.")
+    args = parser.parse_args()
+
+    if args.server_args and args.server_args[0] == "--":
+        args.server_args = args.server_args[1:]
+    args.url = args.url or f"http://localhost:{args.port}"
+
+    processes = spawn_server(args) if args.spawn else []
+    try:
+        asyncio.run(run(args))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
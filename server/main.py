@@ -9,15 +9,33 @@ import asyncio
 import uvicorn
 import time
 import sys
-from collections import defaultdict
 import re
+import models.llm as llm_models
+import models.facial as facial_models
 from models.llm import llm_answer
-from models.facial import predict
+from models.facial import predict_batch
+from models.context_builder import ContextBuilder
+from models.llm_scheduler import LLMScheduler
 import io
 from concurrent.futures import ThreadPoolExecutor
 from langchain_core.messages import AIMessageChunk
+from utils.llm_stream import LLMStream
+from utils.redcap import RedcapClient
+from utils.batcher import MicroBatcher
+from utils.artifacts import ArtifactWriter, FSYNC_POLICIES
+from utils.sessions import SessionRegistry
+from utils.context_store import SessionContext
+from utils.audio_ingress import AudioIngress, OVERFLOW_POLICIES
+from utils.interim import InterimTranscript, unconfirmed_text
+from utils.speech_gate import SpeechGate
+from utils.video_segments import VideoSegmenter, MANIFEST
+from utils.uploader import RedcapUploader
+from utils.audio_codec import make_decoder, supported_formats
+from utils import metrics
+from utils.model_loader import ModelLoader
 import os
 from models.whisper_streaming.whisper_online import *
+from models.asr_scheduler import ASRWorkerPool
 
 # Get all available GPU for parallel processing.
 import torch
@@ -31,38 +49,138 @@ app = cors(app, allow_origin="*")
 import argparse
 
 parser = argparse.ArgumentParser(description="Run the real-time ASR server.")
+parser.add_argument("--port", type=int, default=5000, help="Port to serve on.")
 parser.add_argument("--model", type=str, default="small", help="Size of the Whisper model to use (e.g., 'tiny', 'base', 'small', 'medium', 'large').")
+parser.add_argument("--asr-cpu-workers", type=int, default=1, help="Number of Whisper instances to run when no GPU is available.")
+parser.add_argument("--asr-cpu-threads", type=int, default=4, help="Threads used by each CPU Whisper instance.")
+parser.add_argument("--asr-batch-size", type=int, default=8, help="Maximum number of sessions transcribed together in one batched Whisper inference.")
+parser.add_argument("--asr-max-latency", type=float, default=50, help="Maximum time in milliseconds a transcription waits for other sessions to join its batch.")
+parser.add_argument("--chat-emit-interval", type=float, default=50, help="Time window in milliseconds over which LLM tokens are grouped into one chat_response.")
+parser.add_argument("--chat-emit-tokens", type=int, default=16, help="Maximum number of LLM tokens grouped into one chat_response.")
+parser.add_argument("--face-batch-size", type=int, default=16, help="Maximum number of webcam frames classified together in one facial emotion inference.")
+parser.add_argument("--face-max-wait", type=float, default=20, help="Maximum time in milliseconds a webcam frame waits for others to join its batch.")
+parser.add_argument("--artifact-flush-interval", type=float, default=1, help="Seconds between flushes of buffered session files (video, transcription and logs), 0 flushes every write.")
+parser.add_argument("--artifact-fsync", type=str, default="close", choices=FSYNC_POLICIES, help="When session files are fsynced: never, on every flush, or when the session's files are closed.")
+parser.add_argument("--min-inference-audio", type=float, default=0.5, help="Minimum seconds of new audio a session needs before its next transcription inference, which also sets how often interim hypotheses update.")
+parser.add_argument("--max-inference-audio", type=float, default=2.0, help="Maximum seconds of new audio between inferences during speech, reached when transcription slows down under load.")
+parser.add_argument("--silence-inference-audio", type=float, default=1.0, help="Seconds of new audio between silence checks while nobody speaks.")
+parser.add_argument("--no-speech-gate", action="store_true", help="Transcribe all audio instead of skipping the silence detected by the energy gate.")
+parser.add_argument("--audio-queue-seconds", type=float, default=10, help="Maximum seconds of audio queued per session when transcription falls behind.")
+parser.add_argument("--audio-overflow", type=str, default="drop_oldest", choices=OVERFLOW_POLICIES, help="What to drop when a session's audio queue is full.")
+parser.add_argument("--session-idle-timeout", type=float, default=3600, help="Seconds without any event after which a session is disconnected and its state freed.")
+parser.add_argument("--redcap-timeout", type=float, default=10, help="Timeout in seconds for each REDCap API call.")
+parser.add_argument("--video-segment-seconds", type=float, default=60, help="Duration of the segment files the session video is recorded in.")
+parser.add_argument("--redcap-upload", action="store_true", help="Upload video segments while recording, and the session logs at the end of each visit, to the patient's REDCap folder.")
+parser.add_argument("--upload-rate-limit", type=float, default=2, help="Bandwidth cap in MB/s shared by all REDCap uploads, 0 for no limit.")
+parser.add_argument("--upload-retries", type=int, default=5, help="Attempts of a REDCap upload before it is left for the next server start.")
+parser.add_argument("--redcap-cache-ttl", type=float, default=300, help="Time in seconds a REDCap record stays cached.")
+parser.add_argument("--diarization", action="store_true", help="Label transcript lines with speakers, using one diarization service shared by all sessions.")
+parser.add_argument("--context-budget", type=int, default=8192, help="Maximum tokens of transcript (summary included) in a chat prompt.")
+parser.add_argument("--context-recent", type=int, default=2048, help="Tokens of the latest transcript always kept verbatim in the prompt.")
+parser.add_argument("--summary-chunk", type=int, default=1024, help="Tokens of older transcript that trigger the next rolling summary update.")
+parser.add_argument("--summary-max-tokens", type=int, default=512, help="Maximum tokens of a session's rolling transcript summary.")
+parser.add_argument("--model-wait-timeout", type=float, default=30, help="Seconds a start or chat request waits for its model to finish loading before it is refused.")
+parser.add_argument("--diarization-batch-size", type=int, default=16, help="Maximum number of audio chunks diarized together in one inference.")
+
+args = parser.parse_args()
+# The transcription loop waits for up to this much new audio, a shorter queue would drop it before there is enough.
+if args.audio_queue_seconds < max(args.min_inference_audio, args.max_inference_audio, args.silence_inference_audio):
+    parser.error("--audio-queue-seconds must be at least --min-, --max- and --silence-inference-audio")
+model = args.model
+
+# One Whisper instance per GPU, or --asr-cpu-workers instances on CPU-only hosts. Each worker batches the process_iter calls of the sessions pinned to it.
+ASR_DEVICES = [("cuda", i) for i in GPU_IDS] or [("cpu", 0)] * max(args.asr_cpu_workers, 1)
+asr_pool = ASRWorkerPool(model, ASR_DEVICES, max_batch_size=args.asr_batch_size, max_wait=args.asr_max_latency / 1000, cpu_threads=args.asr_cpu_threads)
 
-model = parser.parse_args().model
+# ThreadPoolExecutor is used to run blocking code in a separate thread, allowing the main event loop to remain responsive.
+executor = ThreadPoolExecutor(max_workers=max(len(GPU_IDS), 1) * 2)
 
-asr = FasterWhisperASR(lan="auto",modelsize=model)
+# process_iter calls block on their worker's scheduler while the batch fills, so they get their own pool sized to a full batch per worker.
+asr_executor = ThreadPoolExecutor(max_workers=args.asr_batch_size * len(asr_pool))
 
-# ThreadPoolExecutor is used to run blocking code in a separate thread, allowing the main event loop to remain responsive.
-executor = ThreadPoolExecutor(max_workers=len(GPU_IDS) * 2)
+# Frames from all sessions are classified together, one processor and model call per batch.
+face_batcher = MicroBatcher(predict_batch, executor, max_batch_size=args.face_batch_size, max_wait=args.face_max_wait / 1000)
+
+# Session files are written by a background thread that keeps their handles open, so disk I/O stays off the event loop.
+artifacts = ArtifactWriter("./videos", flush_interval=args.artifact_flush_interval, fsync=args.artifact_fsync)
+
+# Shared async REDCap client, its connection pool and record cache are used by both the routes and the socket handlers.
+redcap = RedcapClient(timeout=args.redcap_timeout, ttl=args.redcap_cache_ttl)
+
+# Completed video segments go to the patient's REDCap folder during the visit, the logs once it ends.
+uploader = RedcapUploader(redcap, artifacts, rate=args.upload_rate_limit * 1e6, retries=args.upload_retries) if args.redcap_upload else None
+# The logs are append-only and a visit can end several times (page reloads), each time only their new lines are uploaded.
+VISIT_LOGS = ("transcription.txt", "expressionlog.txt", "chatlog.txt", MANIFEST)
+
+# Segmentation and embedding models are loaded once and batched across sessions, each session only keeps its clustering state.
+diarization_service = None
+
+def load_diarization():
+    global diarization_service
+    from models.diarization import DiarizationService
+    diarization_service = DiarizationService(max_batch_size=args.diarization_batch_size)
+
+# Every LLM generation, answers and summaries, runs on the scheduler's single worker, sessions served round-robin.
+llm_scheduler = LLMScheduler()
+
+def summarize(previous_summary, transcript, max_tokens):
+    return llm_scheduler.call(llm_models.summarize, previous_summary, transcript, max_tokens, session_id="summaries").result()
+
+# Keeps the transcript part of chat prompts within budget, summarizing older lines in the background.
+context_builder = ContextBuilder(llm_models.count_tokens, summarize, budget_tokens=args.context_budget, recent_tokens=args.context_recent,
+                                 chunk_tokens=args.summary_chunk, summary_tokens=args.summary_max_tokens)
+
+# Models load in the background once the server is up, all at once, handlers wait for or skip the ones still loading.
+model_loader = ModelLoader()
+model_loader.add("asr", asr_pool.load, asr_pool.warmup)
+model_loader.add("facial", facial_models.load, facial_models.warmup)
+model_loader.add("llm", llm_models.load, llm_models.warmup)
+if args.diarization:
+    model_loader.add("diarization", load_diarization)
 
 # Socket.IO server is initialized with ASGI mode, allowing it to work with the Quart app.
 sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*", ping_timeout=180000, ping_interval=60000)
 
 SAMPLE_RATE       = 16_000
-MIN_CHUNK_SIZE    = 5               # seconds
-CHUNK_SIZE        = int(SAMPLE_RATE * MIN_CHUNK_SIZE)
 
-# Transcribe queue holds audio data for each user session, allowing for asynchronous processing of audio streams.
-transcribe_queue = defaultdict(asyncio.Queue)
-session_name = defaultdict(str)
-user_tasks = defaultdict(asyncio.Task)
-stop_event_list = defaultdict(asyncio.Event)
-transcribe_stop_list = defaultdict(asyncio.Event)
-online_map = defaultdict(OnlineASRProcessor)
+# Registry of the live sessions, holding each session's name, transcription state, chat stream and patient context.
+sessions = SessionRegistry(idle_timeout=args.session_idle_timeout)
+
+# Gauges are read at scrape time, the hot path only records into the histograms of utils.metrics.
+metrics.registry.gauge("live_sessions", "Number of connected sessions.", lambda: len(sessions))
+metrics.registry.gauge("recording_sessions", "Number of sessions being transcribed.", lambda: sum(1 for s in sessions if s.recording))
+metrics.registry.gauge("executor_queue_depth", "Tasks waiting for a thread in each executor.", lambda: {
+    ("default",): executor._work_queue.qsize(),
+    ("asr",): asr_executor._work_queue.qsize(),
+}, labels=("executor",))
+metrics.registry.gauge("asr_worker_queue_depth", "Transcriptions waiting for the next batch of each ASR worker.",
+                       lambda: {(str(i),): worker._requests.qsize() for i, worker in enumerate(asr_pool.workers)}, labels=("worker",))
+metrics.registry.gauge("asr_worker_sessions", "Sessions pinned to each ASR worker.",
+                       lambda: {(str(i),): n for i, n in enumerate(asr_pool.sessions)}, labels=("worker",))
+metrics.registry.gauge("face_batch_queue_depth", "Frames waiting for the facial emotion batcher.", lambda: len(face_batcher._pending))
+metrics.registry.gauge("audio_lag_seconds", "Audio received but not yet transcribed, per recording session.",
+                       lambda: {(s.sid,): s.audio.lag_seconds for s in sessions if s.audio}, labels=("sid",))
+metrics.registry.gauge("asr_gate_skipped_ratio", "Share of the received audio skipped as silence by the speech gate since startup.",
+                       lambda: metrics.ASR_GATE_SECONDS.value("skipped") / max(metrics.ASR_GATE_SECONDS.value("skipped") + metrics.ASR_GATE_SECONDS.value("processed"), 1e-9))
+metrics.registry.gauge("redcap_uploads", "Background REDCap uploads: files queued, uploaded, skipped (never written), failed and retried, bytes uploaded, and pending now.",
+                       lambda: {(k,): v for k, v in {**uploader.stats, "pending": uploader.pending()}.items()} if uploader else {}, labels=("stat",))
+metrics.registry.gauge("llm_kv_cache", "Session KV cache counters (hits, misses, prefill and reused tokens, evictions).",
+                       lambda: {(k,): v for k, v in llm_models.kv_cache.stats.items()} if llm_models.kv_cache else {}, labels=("stat",))
+metrics.registry.gauge("llm_speculative_tokens", "Tokens proposed by the speculative decoding draft and accepted by the model.",
+                       lambda: {(k,): v for k, v in llm_models.draft_model.snapshot().items()} if llm_models.draft_model else {}, labels=("stat",))
+metrics.registry.gauge("llm_speculative_acceptance_rate", "Share of drafted tokens accepted since startup.",
+                       lambda: llm_models.draft_model.acceptance_rate(llm_models.draft_model.snapshot()) if llm_models.draft_model else None)
+metrics.registry.gauge("llm_queue_depth", "LLM jobs (answers and summaries) waiting for the model.", llm_scheduler.queued)
+metrics.registry.gauge("model_ready", "Whether each model is loaded and warmed up.",
+                       lambda: {(name,): int(status["state"] == "ready") for name, status in model_loader.status().items()}, labels=("model",))
 
 @app.route('/api/get_records', methods=['GET'])
 async def get_folders():
     """
     Endpoint to get the list of records in the REDCap database.
     """
-    from utils.redcap import list_records
     try:
-        records = list_records()
+        records = await redcap.list_records()
 
         records = list(map(lambda x: x.get("record_id"), records))  # Convert to empty dicts to avoid sending sensitive data
 
@@ -77,45 +195,151 @@ async def delete_data(patient_name):
     """
     Endpoint to delete all data for a specific patient from the REDCap file repository.
     """
-    from utils.redcap import delete_data
     try:
-        delete_data(patient_name)
-        return jsonify({"message": "Data deleted successfully"}), 200
+        # Folders are named after the patient, fall back to treating the name as a folder ID.
+        folder_id = await redcap.folder_id(patient_name) or patient_name
+        results = await redcap.delete_data(folder_id, progress=lambda done, total, result: print(
+            f"Deleted {done}/{total} documents for {patient_name}" if result["ok"] else f"Failed to delete document {result['item']}: {result['error']}"))
+
+        failed = [result for result in results if not result["ok"]]
+        if failed:
+            return jsonify({"error": "Failed to delete some documents", "deleted": len(results) - len(failed), "failed": failed}), 500
+        return jsonify({"message": "Data deleted successfully", "deleted": len(results)}), 200
     except Exception as e:
         print(f"Error deleting data for {patient_name}: {e}")
         return jsonify({"error": "Failed to delete data"}), 500
 
 
+@app.route("/api/face_batching", methods=["GET"])
+async def face_batching():
+    """
+    Endpoint reporting the throughput and latency of the facial emotion batcher, used to tune --face-batch-size and --face-max-wait.
+    """
+    return jsonify(face_batcher.summary())
+
+
+@app.route("/api/ready", methods=["GET"])
+async def get_ready():
+    """
+    Endpoint reporting the load state and load/warmup timings of each model, 503 until all of them are ready.
+    """
+    ready = model_loader.ready()
+    return jsonify({"ready": ready, "models": model_loader.status()}), 200 if ready else 503
+
+
+@app.route("/api/metrics", methods=["GET"])
+async def get_metrics():
+    """
+    Endpoint exposing the hot-path latency histograms and the load gauges in the Prometheus text format.
+    """
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/sessions", methods=["GET"])
+async def get_sessions():
+    """
+    Endpoint reporting the number of live sessions and an estimate of the memory each one holds.
+    """
+    return jsonify(sessions.stats())
+
+
+async def evict_idle_sessions():
+    """Periodically disconnect idle sessions, the disconnect handler then frees their state."""
+    while True:
+        await asyncio.sleep(min(60, args.session_idle_timeout))
+        for sid in sessions.idle():
+            print(f"Evicting idle session {sid}")
+            await sio.disconnect(sid)
+
+
+@app.before_serving
+async def start_background_tasks():
+    model_loader.start()
+    app.background_tasks = [asyncio.ensure_future(evict_idle_sessions())]
+    if uploader:
+        uploader.resume()
+        uploader.start()
+
+
+@app.after_serving
+async def close_resources():
+    for task in app.background_tasks:
+        task.cancel()
+    if uploader:
+        await uploader.stop()
+    await redcap.close()
+    await asyncio.wrap_future(artifacts.close())
+
+
 # Bind the Socket.IO server to the Quart app.
 app = socketio.ASGIApp(sio, app)
 
 @sio.event
 def connect(sid, environ):
-    online_map[sid] = VACOnlineASRProcessor(MIN_CHUNK_SIZE/16000, asr=asr)
+    # ASR state is only created once the client starts recording.
+    sessions.get(sid)
     print("Client connected")
 
 @sio.event
-def disconnect(sid, reason):
+async def disconnect(sid, reason):
+    await close_session(sid)
     print(f"Client disconnected {reason}")
 
+async def close_session(sid):
+    """Free everything held by a session: transcription, chat stream, patient context, KV cache and open files."""
+    session = sessions.remove(sid)
+    if session is None:
+        return
+    session.closed = True
+
+    await stop_transcription(session)
+    if session.chat_stream:
+        session.chat_stream.cancel()
+    if session.patient_context:
+        session.patient_context.cancel()
+    if session.context.summary_task:
+        session.context.summary_task.cancel()
+    if llm_models.kv_cache:
+        llm_models.kv_cache.drop(sid)
+    if session.video:
+        session.video.finish()
+    end_visit(session)
+
+def write_artifact(session, filename, data):
+    """Append to a file of the session's visit. Dropped once the session is closed, e.g. an answer finishing after a disconnect, so no file is reopened after its final close."""
+    if not session.closed:
+        artifacts.write(session.name, filename, data)
+
+def end_visit(session):
+    """Complete the files of the session's current visit, and queue what is left to upload."""
+    closed = artifacts.close_session(session.name)
+    if uploader and session.name:
+        for filename in VISIT_LOGS:
+            uploader.enqueue(session.name, filename, closed, append=True)
+
 # Face recognition socket event handler
 @sio.on("face_recognition")
 async def face_recognition(sid, data):
     from PIL import Image
 
-    try:
-        # Get the image data from the received data and run the prediction in a separate thread to avoid blocking the event loop.
-        loop = asyncio.get_event_loop()
+    session = sessions.get(sid)
+    # Frames come every few seconds, skipping them until the classifier is warm is better than queueing them.
+    if not model_loader.ready("facial"):
+        return
 
-        top = await loop.run_in_executor(executor, predict, Image.open(io.BytesIO(data["image_data"])))
-        if (not os.path.isdir(f"./videos/{session_name[sid]}")):
-            os.makedirs(f"./videos/{session_name[sid]}")
+    try:
+        # Get the image data from the received data and hand it to the batcher, which runs the prediction in a separate thread to avoid blocking the event loop.
+        start = time.monotonic()
+        # Image.open only reads the header, the frame is decoded here so a corrupt one fails on its own instead of inside the batch.
+        image = await asyncio.get_running_loop().run_in_executor(executor, lambda: Image.open(io.BytesIO(data["image_data"])).convert("RGB"))
+        top = await face_batcher.submit(image)
+        metrics.PREDICT_SECONDS.observe(time.monotonic() - start)
 
         if top == "NONE":
             return
         
-        with open(f"./videos/{session_name[sid]}/expressionlog.txt", 'a') as f:
-            f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} - {top}\n")
+        write_artifact(session, "expressionlog.txt", f"{time.strftime('%Y-%m-%d %H:%M:%S')} - {top}\n")
+        session.context.add_emotions(top)
 
         await sio.emit("face_recognition_ans", {
             "message": top
@@ -128,53 +352,155 @@ async def face_recognition(sid, data):
 # Audio producer that adds audio data to the transcribe queue for each user session.
 @sio.on("audio")
 async def handle_audio(sid, data):
-    global transcribe_queue
+    session = sessions.get(sid)
+    if session.audio is None:
+        return  # Not recording, e.g. chunks still in flight after stop
+
     try:
-        pcm = np.frombuffer(data["audio_data"], dtype=np.float32)
-        await transcribe_queue[sid].put(pcm)
+        pcm = session.audio_decoder(data["audio_data"])
+        if session.audio.put(pcm):
+            print(f"Transcription of {sid} is {session.audio.lag_seconds:.1f}s behind, dropped audio ({args.audio_overflow})")
     except Exception as e:
         print(f"Error processing audio: {e}")
         await sio.emit("error", {"message": "Error processing audio"})
 
+def upload_segment(session_name, filename, closed):
+    # Segments of a recording started before the visit is named are uploaded once they are moved to its folder.
+    if uploader and session_name:
+        uploader.enqueue(session_name, filename, closed)
+
 # Video handler that saves incoming video data to a file.
 @sio.on("video")
 async def handle_video(sid, data):
-    if (not os.path.isdir(f"./videos/{session_name[sid]}")):
-        os.makedirs(f"./videos/{session_name[sid]}")
-    with open(f"./videos/{session_name[sid]}/video_{sid}.webm", 'ab') as f:
-        f.write(data["video_data"])
+    session = sessions.get(sid)
+    if session.video is None:
+        session.video = VideoSegmenter(artifacts, session.name, f"video_{sid}", args.video_segment_seconds, upload_segment)
+    session.video.add(data["video_data"])
 
 # Asynchronous consummer that processes audio data from the transcribe queue, performs transcription, and emits the results back to the client.
-async def transcribe(sid):
-    if (not os.path.isdir(f"./videos/{session_name[sid]}")):
-        os.makedirs(f"./videos/{session_name[sid]}")
-
-    while not transcribe_stop_list[sid].is_set():
-        pcm = await transcribe_queue[sid].get()
-        online_map[sid].insert_audio_chunk(pcm)
-        if transcribe_stop_list[sid].is_set():
-            print(online_map[sid].finish())
+async def transcribe(session):
+    # Stop clears these from the session, the loop keeps its own references until it exits.
+    audio, online, diarization = session.audio, session.online, session.diarization
+    gate = None if args.no_speech_gate else SpeechGate(
+        SAMPLE_RATE, min_interval=args.min_inference_audio, max_interval=args.max_inference_audio, silence_interval=args.silence_inference_audio)
+    interim = InterimTranscript()
+    failed = False  # Whether the last inference failed, the client is told once per run of failures
+    while True:
+        # Take everything queued since the last inference, once there is enough new audio to be worth one.
+        interval = gate.interval() if gate else args.min_inference_audio
+        pcm = await audio.get(int(interval * SAMPLE_RATE))
+        if pcm is None or audio.closed:
+            print(online.finish())
+            diff = interim.clear()
+            if diff:
+                await sio.emit("audio_interim", diff, to=session.sid)
             break
+        metrics.TRANSCRIBE_QUEUE_WAIT.observe(audio.last_wait)
+        received = len(pcm)
+        if gate:
+            # Silence skips the VAC, the diarization and the inference altogether.
+            pcm = gate.gate(pcm)
+            if pcm is None:
+                metrics.ASR_GATE_SECONDS.inc(received / SAMPLE_RATE, "skipped")
+                audio.mark_processed(received)
+                continue
+            metrics.ASR_GATE_SECONDS.inc(received / SAMPLE_RATE, "processed")
+        online.insert_audio_chunk(pcm)
+        if diarization:
+            await diarization.diarize(pcm)
         
         loop = asyncio.get_event_loop()
-        ans = await loop.run_in_executor(executor, online_map[sid].process_iter)
+        start = time.monotonic()
+        try:
+            ans = await loop.run_in_executor(asr_executor, online.process_iter)
+        except Exception as e:
+            # The audio stays in the processor's buffer and is transcribed again with the next inference.
+            print(f"Error transcribing audio for SID {session.sid}: {e}")
+            audio.mark_processed(received)
+            if not failed:
+                await sio.emit("error", {"message": "Error transcribing audio"}, to=session.sid)
+            failed = True
+            continue
+        failed = False
+        elapsed = time.monotonic() - start
+        metrics.PROCESS_ITER_SECONDS.observe(elapsed)
+        metrics.TRANSCRIBE_RTF.observe(elapsed / (len(pcm) / SAMPLE_RATE))
+        if gate:
+            gate.observe(elapsed, len(pcm))
+        audio.mark_processed(received)
         if ans[2]:
-            with open(f"./videos/{session_name[sid]}/transcription.txt", 'a') as f:
-                f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} > ")
-                f.write(f"{ans[2]}\n")
-            await sio.emit("audio_ans", {"text": ans[2]}, to=sid)
+            speaker = diarization.speaker_at(ans[0], ans[1]) if diarization else None
+            label = f"Speaker {speaker}: " if speaker else ""
+            write_artifact(session, "transcription.txt", f"{time.strftime('%Y-%m-%d %H:%M:%S')} > {label}{ans[2]}\n")
+            # start/end are seconds from the start of recording, they let clients measure end-to-end transcript latency.
+            begin, end = (gate.to_recording_time(ans[0]), gate.to_recording_time(ans[1])) if gate else ans[:2]
+            await sio.emit("audio_ans", {"text": ans[2], "speaker": speaker, "start": begin, "end": end}, to=session.sid)
+            session.context.add_transcript(ans[2], speaker)
+            if model_loader.ready("llm"):
+                await context_builder.update(session.context)
+
+        # The words transcribed once but not confirmed yet are shown right away, as a diff against the hypothesis the client has.
+        end, text = unconfirmed_text(online)
+        diff = interim.update(text)
+        if diff:
+            diff["end"] = gate.to_recording_time(end) if gate else end
+            await sio.emit("audio_interim", diff, to=session.sid)
 
 # Socket.IO event handler to start the transcription process for a user session.
 @sio.on("start")
-async def start_up(sid):
+async def start_up(sid, data=None):
+    """
+    Start transcribing a session. The client can ask for a compact audio wire format with {"format": ...},
+    the format actually used is returned in the acknowledgement, falling back to raw float32.
+    """
+    print("Starting up")
+
+    session = sessions.get(sid)
+    if session.recording:
+        await stop_transcription(session)
+
+    # The client only sends audio once start is acknowledged, so waiting here queues the session until Whisper is warm.
+    if not await model_loader.wait("asr", args.model_wait_timeout):
+        print(f"Speech recognition not ready, refusing start from {sid}")
+        return {"error": "Speech recognition is still loading, try again shortly"}
+
+    formats = supported_formats()
+    audio_format = (data or {}).get("format", "float32")
+    if audio_format not in formats:
+        print(f"Unsupported audio format {audio_format} for {sid}, using float32")
+        audio_format = "float32"
+    session.audio_decoder = make_decoder(audio_format)
+
+    # The ASR state is created lazily here and freed again on stop.
+    session.asr_worker = asr_pool.acquire()
+    # The chunk size is in seconds: the wrapped online processor runs once that much voiced audio is buffered.
+    session.online = VACOnlineASRProcessor(args.min_inference_audio, asr=asr_pool.client(session.asr_worker))
+    session.audio = AudioIngress(args.audio_queue_seconds, args.audio_overflow, SAMPLE_RATE)
+    if diarization_service:
+        from models.diarization import DiartDiarization
+        session.diarization = DiartDiarization(SAMPLE_RATE, service=diarization_service)
+    session.transcribe_task = sio.start_background_task(transcribe, session)
+
+    return {"format": audio_format, "formats": formats}
+
+async def stop_transcription(session):
+    """Stop the transcription task of a session and free its ASR state."""
+    # Cancel the transcription task for the user session if it is running.
+    if session.transcribe_task and not session.transcribe_task.done():
+        session.audio.close()  # Signal the transcription task to stop
+        session.transcribe_task.cancel()
 
-    global transcribe_queue
+    if session.asr_worker is not None:
+        asr_pool.release(session.asr_worker)
 
-    print("Starting up")
+    if session.diarization:
+        session.diarization.close()
 
-    transcribe_queue[sid] = asyncio.Queue()
-    transcribe_stop_list[sid] = asyncio.Event()
-    user_tasks[sid] = sio.start_background_task(transcribe, sid)
+    session.asr_worker = None
+    session.diarization = None
+    session.transcribe_task = None
+    session.audio = None
+    session.online = None
 
 @sio.on("session_name")
 async def handle_session_name(sid, data):
@@ -182,29 +508,43 @@ async def handle_session_name(sid, data):
     Socket.IO event handler to set the session name for a user session.
     This is used to identify the session for transcription and other operations.
     """
-    global session_name
+    session = sessions.get(sid)
+
+    name = data.get("session_name", "unnamed_session")
+
+    # A recording going on continues in the new visit's folder, with what it recorded before the visit was named.
+    if session.video:
+        session.video.move_to(name)
 
-    # Store the session name in the global dictionary.
-    session_name[sid] = data.get("session_name", "unnamed_session")
+    # Files of the previous visit on this connection are done.
+    if session.name:
+        end_visit(session)
 
-    print(f"Session name for {sid} set to {session_name[sid]}")
+    # Store the session name on the session.
+    session.name = name
+    if session.context.summary_task:
+        session.context.summary_task.cancel()
+    session.context = SessionContext()
 
-    await sio.emit("session_name_set", {"session_name": session_name[sid]}, to=sid)
+    # A new visit starts from fresh REDCap data, fetched once in the background so chat messages never wait on it.
+    redcap.invalidate(session.name)
+    if session.patient_context:
+        session.patient_context.cancel()
+    session.patient_context = asyncio.ensure_future(redcap.get_patient_context(session.name))
+
+    print(f"Session name for {sid} set to {session.name}")
+
+    await sio.emit("session_name_set", {"session_name": session.name}, to=sid)
 
 # Socket.IO event handler to stop the transcription process for a user session.
 @sio.on("stop")
 async def handle_stop(sid):
-    global transcribe_queue, user_tasks
-
-    # Cancel the transcription task for the user session if it is running.
-    if user_tasks.get(sid):
-        if user_tasks[sid] and not user_tasks[sid].done():
-            transcribe_queue[sid].put_nowait(None)  # Signal the transcription task to stop
-            transcribe_stop_list[sid].set()  # Set the stop event to signal the task to stop
-            user_tasks[sid].cancel()
+    session = sessions.get(sid)
 
-        del transcribe_queue[sid]
-        del user_tasks[sid]
+    await stop_transcription(session)
+    if session.video:
+        session.video.finish()  # The next start is a new MediaRecorder stream, with a header of its own
+    artifacts.close_session(session.name)
 
     await sio.emit("stopped", {"message": "Transcription stopped"}, to=sid)
 
@@ -213,58 +553,88 @@ async def handle_stop(sid):
 async def handle_chat_message(sid, data):
     print(f"Received chat message from {sid}: {data}")
 
-    from utils.redcap import get_screening_prettify, get_patient_previsit
-    loop = asyncio.get_event_loop()
-    screening = get_screening_prettify(session_name[sid])
-    previsit = get_patient_previsit(session_name[sid])
-        
-    combined = {
-        "screening": screening if screening["screening_complete"] == "2" else None,
-        "previsit": previsit if previsit and previsit["patient_previsit_complete"] == "2" else None
-    }
-
-    if (not os.path.isdir(f"./videos/{session_name[sid]}")):
-        os.makedirs(f"./videos/{session_name[sid]}")
-
-    with open(f"./videos/{session_name[sid]}/chatlog.txt", 'a') as f:
-        f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} - User: {data['message']}\n\n")
-
-    out = await loop.run_in_executor(executor, llm_answer, data['message'], data.get('history', None), data.get('transcription', None), data.get("emotions", None), combined)
-
-    # Conditional var to handle stopping the stream based on client request.
-    stop_event_list[sid] = asyncio.Event()
-
-    async def _stream_llm(sid, out, stop_event):
-        with open(f"./videos/{session_name[sid]}/chatlog.txt", 'a') as f:
-            f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} - AI:")
-            for chunk in out:
-                if stop_event.is_set():
-                    print(f"Stream for SID {sid} cancelled by client request.")
-
-                    # This emits when the stream is stopped by the client.
-                    await sio.emit("stream_end", {"message": "BREAK"}, to=sid)
-                    return  # Exit the loop if the stop event is set
-                
-                # Check if the chunk is an AIMessageChunk and emit the content to the client (chunk might also be ToolMessageChunk from the search tool)
-                # if isinstance(chunk[0], AIMessageChunk):
-                #     f.write(f"{chunk[0].content}")
-                #     await sio.emit("chat_response", {"message": chunk[0].content}, to=sid)
-                f.write(chunk.content)
-                await sio.emit("chat_response", {"message": chunk.content}, to=sid)
-            f.write("\n")
+    session = sessions.get(sid)
+
+    if not await model_loader.wait("llm", args.model_wait_timeout):
+        print(f"LLM not ready, refusing chat message from {sid}")
+        await sio.emit("error", {"message": "The assistant is still loading, try again shortly"}, to=sid)
+        await sio.emit("stream_end", {"message": "BREAK"}, to=sid)
+        return
+
+    # The patient context was prefetched when the session name was set, answer without it rather than wait on REDCap.
+    combined = None
+    context_task = session.patient_context
+    if context_task is None:
+        session.patient_context = asyncio.ensure_future(redcap.get_patient_context(session.name))
+    elif not context_task.done():
+        print(f"Patient context for {session.name} is still loading, answering without it")
+    elif context_task.exception():
+        print(f"Error loading patient context for {session.name}: {context_task.exception()}")
+        session.patient_context = asyncio.ensure_future(redcap.get_patient_context(session.name))
+    else:
+        combined = context_task.result()
+
+    write_artifact(session, "chatlog.txt", f"{time.strftime('%Y-%m-%d %H:%M:%S')} - User: {data['message']}\n\n")
+
+    # Generation runs on the LLM scheduler's worker, the event loop only forwards grouped tokens to the client.
+    # While the answer waits for the model, the client gets its place in line as chat_queue events, 0 once it starts.
+    # Transcript, emotions and history come from the session's context store, the message only carries the question.
+    context = session.context
+    question = data['message']
+    transcript = await context_builder.build(context)
+    await context_builder.update(context)
+    stream = LLMStream(llm_answer, question, list(context.history), transcript or None, context.emotion_lines() or None, combined, sid,
+                       max_delay=args.chat_emit_interval / 1000, max_tokens=args.chat_emit_tokens,
+                       scheduler=llm_scheduler, session_id=sid, on_position=lambda position: sio.emit("chat_queue", {"position": position}, to=sid))
+    session.chat_stream = stream
+    stream.start()
+
+    async def _stream_llm(session, stream):
+        write_artifact(session, "chatlog.txt", f"{time.strftime('%Y-%m-%d %H:%M:%S')} - AI:")
+        answer = []
+        async for text in stream:
+            answer.append(text)
+            write_artifact(session, "chatlog.txt", text)
+            await sio.emit("chat_response", {"message": text}, to=session.sid)
+        write_artifact(session, "chatlog.txt", "\n")
+
+        if stream.time_to_first_token is not None:
+            metrics.LLM_TTFT_SECONDS.observe(stream.time_to_first_token)
+        if stream.tokens_per_second is not None:
+            metrics.LLM_TOKENS_PER_SECOND.observe(stream.tokens_per_second)
+
+        if session.chat_stream is stream:
+            session.chat_stream = None
+
+        if stream.error:
+            print(f"Error generating answer for SID {session.sid}: {stream.error}")
+            await sio.emit("error", {"message": "Error generating answer"}, to=session.sid)
+
+        if stream.cancelled or stream.error:
+            if stream.cancelled:
+                print(f"Stream for SID {session.sid} cancelled by client request.")
+
+            # This emits when the stream is stopped by the client.
+            await sio.emit("stream_end", {"message": "BREAK"}, to=session.sid)
+            return
+
         # This is emit when the stream completes
-        await sio.emit("stream_end", {"message": "END"}, to=sid)
+        context.add_turn(question, "".join(answer))
+        await sio.emit("stream_end", {"message": "END"}, to=session.sid)
 
-    sio.start_background_task(_stream_llm, sid, out, stop_event_list[sid])
+    sio.start_background_task(_stream_llm, session, stream)
 
 # Handle the stop event, signaling stop chat condition var
 @sio.on("stop_chat")
 async def handle_stop_chat(sid):
     print(f"Stopping chat stream for {sid}")
 
-    if sid in stop_event_list:
-        stop_event_list[sid].set()
-        del stop_event_list[sid]
+    session = sessions.get(sid)
+
+    # Cancelling frees the answer's place in the queue, or stops its generation, the stream task then emits the BREAK.
+    if session.chat_stream:
+        session.chat_stream.cancel()
+        session.chat_stream = None
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=5000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=args.port)
\ No newline at end of file
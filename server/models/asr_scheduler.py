@@ -0,0 +1,311 @@
+import logging
+import queue
+import threading
+import time
+from bisect import bisect_right
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+from models.whisper_streaming.whisper_online import FasterWhisperASR
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_RATE = 16000
+
+# Whisper decodes fixed 30 second windows, longer buffers can't share a batch with other sessions.
+MAX_BATCHED_SECONDS = 30
+
+# Audio a language is detected from before it is kept for the rest of the session, shorter buffers are detected again.
+LANGUAGE_DETECT_SECONDS = 5
+
+# Minimal stand-ins for faster-whisper's Segment/Word, only the fields whisper_streaming reads (ts_words, segments_end_ts).
+Word = namedtuple("Word", ["start", "end", "word", "probability"])
+Segment = namedtuple("Segment", ["start", "end", "text", "no_speech_prob", "words"])
+
+# A queued transcription, client is the ScheduledASR of the session it comes from.
+Request = namedtuple("Request", ["audio", "init_prompt", "client", "future"])
+
+
+class BatchedFasterWhisperASR(FasterWhisperASR):
+    """
+    FasterWhisperASR that can also transcribe the buffers of several sessions in one batched inference.
+    Unlike the base class, which always loads on the first GPU, the model can be placed on any GPU or on the CPU.
+    Args:
+        device (str): "cuda" or "cpu".
+        device_index (int): GPU index when device is "cuda".
+        cpu_threads (int): Threads used by a CPU instance, 0 lets CTranslate2 decide.
+    """
+
+    def __init__(self, lan, modelsize=None, device="cuda", device_index=0, cpu_threads=0, **kwargs):
+        self.device = device
+        self.device_index = device_index
+        self.cpu_threads = cpu_threads
+        super().__init__(lan, modelsize=modelsize, **kwargs)
+
+    def load_model(self, modelsize=None, cache_dir=None, model_dir=None):
+        from faster_whisper import BatchedInferencePipeline, WhisperModel
+
+        model_size_or_path = model_dir if model_dir is not None else modelsize
+        compute_type = "float16" if self.device == "cuda" else "int8"
+        model = WhisperModel(model_size_or_path, device=self.device, device_index=self.device_index, compute_type=compute_type,
+                             cpu_threads=self.cpu_threads, download_root=cache_dir)
+        self.pipeline = BatchedInferencePipeline(model=model)
+        return model
+
+    def transcribe(self, audio, init_prompt="", language=None):
+        """FasterWhisperASR.transcribe, decoding in the given language instead of the configured one when it is set."""
+        if language is None:
+            return super().transcribe(audio, init_prompt=init_prompt)
+        segments, _ = self.model.transcribe(audio, language=language, initial_prompt=init_prompt, beam_size=5,
+                                            word_timestamps=True, condition_on_previous_text=True, **self.transcribe_kargs)
+        return list(segments)
+
+    def detect_language(self, audio):
+        """Language code spoken in an audio buffer."""
+        language, _, _ = self.model.detect_language(audio)
+        return language
+
+    def transcribe_batch(self, audios, language=None):
+        """
+        Transcribe independent audio buffers in a single batched forward pass.
+        The buffers are laid end to end and each one is passed as its own clip, so faster-whisper decodes them as separate batch items.
+        Per-session prompts can't be batched, so batched items are decoded without an initial prompt. The whole batch is
+        decoded in one language, without one it is detected from the first buffer.
+        Args:
+            audios (list[np.ndarray]): float32 16kHz buffers, each at most MAX_BATCHED_SECONDS long.
+            language (str, optional): Language of every buffer, defaults to the configured one.
+        Returns:
+            list[list[Segment]]: The segments of each buffer, with timestamps relative to the start of that buffer.
+        """
+        clips = []
+        offsets = []
+        position = 0
+        for audio in audios:
+            clips.append({"start": position, "end": position + len(audio)})
+            offsets.append(position / SAMPLING_RATE)
+            position += len(audio)
+
+        kwargs = {k: v for k, v in self.transcribe_kargs.items() if k != "vad_filter"}
+        segments, _ = self.pipeline.transcribe(
+            np.concatenate(audios),
+            language=language or self.original_language,
+            clip_timestamps=clips,
+            vad_filter=False,
+            batch_size=len(audios),
+            beam_size=5,
+            word_timestamps=True,
+            **kwargs,
+        )
+
+        results = [[] for _ in audios]
+        for segment in segments:
+            # Segment times are absolute in the concatenated audio, map them back to the buffer they came from.
+            i = max(bisect_right(offsets, segment.start + 1e-3) - 1, 0)
+            offset = offsets[i]
+            words = [Word(w.start - offset, w.end - offset, w.word, w.probability) for w in (segment.words or [])]
+            results[i].append(Segment(segment.start - offset, segment.end - offset, segment.text, segment.no_speech_prob, words))
+        return results
+
+
+class ScheduledASR:
+    """
+    Stand-in for the shared ASR object that is handed to each session's OnlineASRProcessor.
+    transcribe() goes through the scheduler, everything else (sep, ts_words, segments_end_ts, ...) is the real backend's.
+    It also holds the language detected for the session, once the scheduler has detected it from enough audio.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.language = None
+
+    def transcribe(self, audio, init_prompt=""):
+        return self.scheduler.transcribe(audio, init_prompt, self)
+
+    def __getattr__(self, name):
+        return getattr(self.scheduler.asr, name)
+
+
+class ASRScheduler:
+    """
+    Central scheduler that gathers the pending transcriptions of all sessions and runs them as one batched inference.
+    A batch is decoded in a single language. Without a configured language, each session's language is detected on its
+    own and kept once detected from enough audio, and the sessions of a batch are grouped by language.
+    If a batched inference fails, its buffers are transcribed one by one, so a bad buffer only fails its own session.
+
+    Args:
+        asr: The shared ASR backend. Batches are used when it provides transcribe_batch, otherwise requests run one by one.
+        max_batch_size (int): Maximum number of session buffers in one inference.
+        max_wait (float): Maximum time in seconds the first request of a batch waits for others to join (the added latency).
+    """
+
+    def __init__(self, asr, max_batch_size=8, max_wait=0.05):
+        self.asr = asr
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self._requests = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="asr-scheduler", daemon=True)
+        self._worker.start()
+
+    def client(self):
+        """Return an ASR object to pass to a session's VACOnlineASRProcessor."""
+        return ScheduledASR(self)
+
+    def transcribe(self, audio, init_prompt="", client=None):
+        """Queue a buffer for transcription and block until its batch has run. Called from the executor threads running process_iter."""
+        future = Future()
+        self._requests.put(Request(audio, init_prompt, client, future))
+        return future.result()
+
+    def _collect(self):
+        """Wait for a request, then gather more until the batch is full or max_wait has passed."""
+        batch = [self._requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                self._dispatch(batch)
+            except Exception as e:
+                logger.exception("Batched transcription failed")
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+    def _dispatch(self, batch):
+        batched, single = [], []
+        for request in batch:
+            if 0 < len(request.audio) <= MAX_BATCHED_SECONDS * SAMPLING_RATE:
+                batched.append(request)
+            else:
+                single.append((request, self._known_language(request)))
+
+        if len(batched) > 1 and hasattr(self.asr, "transcribe_batch"):
+            groups = {}
+            for request in batched:
+                groups.setdefault(self._language(request), []).append(request)
+            for language, requests in groups.items():
+                if language is not None and len(requests) > 1:
+                    self._transcribe_batch(requests, language)
+                else:
+                    single += [(request, language) for request in requests]
+        else:
+            single = [(request, self._known_language(request)) for request in batched] + single
+
+        # A lone request keeps its prompt and runs exactly like a direct asr.transcribe call.
+        for request, language in single:
+            self._transcribe(request, language)
+
+    @staticmethod
+    def _known_language(request):
+        """Language kept for the session of a request, None to leave it to the backend."""
+        return request.client.language if request.client is not None else None
+
+    def _language(self, request):
+        """Language of a request, detected unless configured or already known for its session, None if detection failed."""
+        if self.asr.original_language is not None:
+            return self.asr.original_language
+        language = self._known_language(request)
+        if language is not None:
+            return language
+        try:
+            language = self.asr.detect_language(request.audio)
+        except Exception:
+            logger.exception("Language detection failed")
+            return None
+        if request.client is not None and len(request.audio) >= LANGUAGE_DETECT_SECONDS * SAMPLING_RATE:
+            request.client.language = language
+        return language
+
+    def _transcribe_batch(self, requests, language):
+        logger.debug(f"Running batched transcription of {len(requests)} sessions in {language}")
+        try:
+            results = self.asr.transcribe_batch([request.audio for request in requests], language=language)
+        except Exception:
+            logger.exception(f"Batched transcription of {len(requests)} sessions failed, transcribing them one by one")
+            for request in requests:
+                self._transcribe(request, language)
+            return
+        for request, result in zip(requests, results):
+            request.future.set_result(result)
+
+    def _transcribe(self, request, language=None):
+        try:
+            if language is None or language == self.asr.original_language:
+                result = self.asr.transcribe(request.audio, init_prompt=request.init_prompt)
+            else:
+                result = self.asr.transcribe(request.audio, init_prompt=request.init_prompt, language=language)
+            request.future.set_result(result)
+        except Exception as e:
+            request.future.set_exception(e)
+
+
+class ASRWorkerPool:
+    """
+    Pool of ASR workers, each one model instance with its own ASRScheduler, so throughput scales with the hardware.
+    Each session is pinned to one worker for its whole recording, placed on the worker with the fewest sessions when it starts.
+
+    Args:
+        modelsize (str): Whisper model size.
+        devices (list[tuple[str, int]]): (device, device_index) of each worker, e.g. one ("cuda", i) per GPU or N ("cpu", 0).
+        max_batch_size (int): Maximum batch size of each worker's scheduler.
+        max_wait (float): Maximum added latency of each worker's scheduler, in seconds.
+        cpu_threads (int): Threads per CPU worker.
+    """
+
+    def __init__(self, modelsize, devices, max_batch_size=8, max_wait=0.05, cpu_threads=0):
+        self.modelsize = modelsize
+        self.devices = devices
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cpu_threads = cpu_threads
+        self.workers = []  # Filled by load()
+        self.sessions = [0] * len(devices)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def _load_worker(self, device, index):
+        asr = BatchedFasterWhisperASR(lan="auto", modelsize=self.modelsize, device=device, device_index=index, cpu_threads=self.cpu_threads)
+        return ASRScheduler(asr, max_batch_size=self.max_batch_size, max_wait=self.max_wait)
+
+    def load(self):
+        """Load the model of every worker, all devices at once."""
+        with ThreadPoolExecutor(max_workers=len(self.devices)) as pool:
+            self.workers = list(pool.map(lambda device: self._load_worker(*device), self.devices))
+
+    def warmup(self):
+        """Run one batched and one single transcription on every worker, so the first session doesn't pay for CUDA and CTranslate2 setup."""
+        rng = np.random.default_rng(0)
+        audio = (rng.standard_normal(SAMPLING_RATE) * 0.01).astype(np.float32)
+        for worker in self.workers:
+            worker.asr.transcribe_batch([audio, audio])
+            worker.asr.transcribe(audio)
+
+    def acquire(self):
+        """Pin a new session to the least loaded worker, returns the worker index."""
+        with self._lock:
+            worker = min(range(len(self.workers)), key=lambda i: self.sessions[i])
+            self.sessions[worker] += 1
+        logger.info(f"Session placed on ASR worker {worker} ({self.devices[worker][0]}:{self.devices[worker][1]})")
+        return worker
+
+    def release(self, worker):
+        with self._lock:
+            self.sessions[worker] = max(self.sessions[worker] - 1, 0)
+
+    def client(self, worker):
+        """ASR object to pass to the VACOnlineASRProcessor of a session pinned to a worker."""
+        return self.workers[worker].client()
@@ -0,0 +1,96 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ContextBuilder:
+    """
+    Builds the transcript section of the prompt within a token budget, so its prefill cost stays flat over a long visit.
+
+    The most recent transcript lines are kept verbatim. Older lines are folded into a rolling summary of the session,
+    computed in the background chunk by chunk: each update summarizes the previous summary plus the lines that left the
+    recent window, so no line is summarized twice. Summaries and per-line token counts are cached on the SessionContext.
+    Tokenizing is model work, so lines are counted on a thread of the builder, never on the event loop.
+
+    Args:
+        count_tokens (callable): Number of tokens of a text with the model's tokenizer.
+        summarize (callable): summarize(previous_summary, transcript, max_tokens) -> new summary, blocking.
+        budget_tokens (int): Maximum tokens of the transcript section, summary included.
+        recent_tokens (int): Tokens of the latest lines that are always kept verbatim and never summarized.
+        chunk_tokens (int): Tokens of older lines that trigger the next summary update.
+        summary_tokens (int): Maximum tokens of the summary.
+    """
+
+    def __init__(self, count_tokens, summarize, budget_tokens=8192, recent_tokens=2048, chunk_tokens=1024, summary_tokens=512):
+        if recent_tokens + summary_tokens > budget_tokens:
+            raise ValueError("recent_tokens + summary_tokens must fit in budget_tokens")
+
+        self.count_tokens = count_tokens
+        self.summarize = summarize
+        self.budget_tokens = budget_tokens
+        self.recent_tokens = recent_tokens
+        self.chunk_tokens = chunk_tokens
+        self.summary_tokens = summary_tokens
+        # One summary at a time, they share the model with the chat answers.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summarizer")
+        # One thread counts tokens for build() and update(), so each line is counted once and only there.
+        self._count_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="context-tokens")
+
+    def _count_lines(self, context):
+        """Count the tokens of the lines that finished since the last call."""
+        for i in range(len(context.line_tokens), context.finished_lines()):
+            context.line_tokens.append(self.count_tokens(context.text(i, i + 1)))
+
+    def _window_start(self, context, budget, used=0):
+        """First line of the newest lines fitting in budget, given the tokens already used, never before the summarized lines."""
+        start = context.finished_lines()
+        while start > context.summarized and used + context.line_tokens[start - 1] <= budget:
+            start -= 1
+            used += context.line_tokens[start]
+        return start
+
+    async def update(self, context):
+        """Start a summary update once enough lines have left the recent window. Called after new transcript lines, cheap otherwise."""
+        await asyncio.get_running_loop().run_in_executor(self._count_executor, self._count_lines, context)
+        if context.summary_task and not context.summary_task.done():
+            return
+
+        end = self._window_start(context, self.recent_tokens)
+        if sum(context.line_tokens[context.summarized:end]) >= self.chunk_tokens:
+            context.summary_task = asyncio.ensure_future(self._summarize(context, end))
+
+    async def _summarize(self, context, end):
+        start = context.summarized
+        loop = asyncio.get_running_loop()
+        try:
+            summary = await loop.run_in_executor(self._executor, self.summarize, context.summary, context.text(start, end), self.summary_tokens)
+            summary_tokens = await loop.run_in_executor(self._count_executor, self.count_tokens, summary)
+        except Exception as e:
+            print(f"Error summarizing transcript lines {start}-{end}: {e}")
+            return
+
+        context.summary = summary
+        context.summary_tokens = summary_tokens
+        context.summarized = end
+        print(f"Summarized transcript lines {start}-{end} into {context.summary_tokens} tokens")
+
+    async def build(self, context):
+        """The transcript section for the next question: the summary, then as many of the latest lines as fit the budget."""
+        return await asyncio.get_running_loop().run_in_executor(self._count_executor, self._build, context)
+
+    def _build(self, context):
+        if not context.lines:
+            return ""
+        self._count_lines(context)
+
+        last = context.text(-1)
+        budget = self.budget_tokens - context.summary_tokens
+        start = self._window_start(context, budget, self.count_tokens(last))
+
+        parts = []
+        if context.summary:
+            parts.append(f"Summary of the earlier conversation: {context.summary}")
+        if start > context.summarized:
+            # Lines between the summary and the window are left out until the background summary catches up.
+            parts.append("[...]")
+        parts.append(context.text(start))
+        return "\n".join(parts)
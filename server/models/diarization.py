@@ -1,7 +1,11 @@
 import asyncio
 import re
+from bisect import bisect_left, bisect_right
+import queue
 import threading
+import time
 import numpy as np
+import torch
 import logging
 
 
@@ -12,7 +16,7 @@ from whisperlivekit.timed_objects import SpeakerSegment
 from diart.sources import MicrophoneAudioSource
 from rx.core import Observer
 from typing import Tuple, Any, List
-from pyannote.core import Annotation
+from pyannote.core import Annotation, SlidingWindow, SlidingWindowFeature
 
 logger = logging.getLogger(__name__)
 
@@ -20,11 +24,106 @@ def extract_number(s: str) -> int:
     m = re.search(r'\d+', s)
     return int(m.group()) if m else None
 
+class SegmentSnapshot:
+    """
+    Read-only view of the segments of a SegmentStore at one point in time, taken without copying.
+    The store only appends to its list in place and builds a new list for anything else, so the view's range never changes under it.
+    """
+
+    def __init__(self, segments, starts, head, tail, max_duration):
+        self._segments = segments
+        self._starts = starts
+        self._head = head
+        self._tail = tail
+        self.max_duration = max_duration
+
+    def __len__(self):
+        return self._tail - self._head
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._segments[self._head + i]
+
+    def __iter__(self):
+        for i in range(self._head, self._tail):
+            yield self._segments[i]
+
+    def start_index(self, time):
+        """Index of the first segment that may still overlap the given time, using the longest segment duration as bound."""
+        return bisect_left(self._starts, time - self.max_duration, self._head, self._tail) - self._head
+
+
+class SegmentStore:
+    """
+    Time-sorted, bounded store of speaker segments.
+    Segments are kept ordered by start with a parallel list of starts for bisection. Old segments are dropped by moving a head
+    index forward, the lists are compacted once most of them is dead, and at most max_segments are kept.
+    Segments longer than max_piece are stored as consecutive pieces, so the longest duration that lookups step back by
+    stays bounded and one long monologue doesn't make every lookup walk back over the whole store.
+    Args:
+        max_segments (int): Maximum number of live segments.
+        max_piece (float): Maximum duration in seconds of a stored segment.
+    """
+
+    def __init__(self, max_segments=4096, max_piece=5.0):
+        self.max_segments = max_segments
+        self.max_piece = max_piece
+        self.max_duration = 0.0
+        self._segments = []
+        self._starts = []
+        self._head = 0
+
+    def __len__(self):
+        return len(self._segments) - self._head
+
+    def add(self, segment):
+        start = segment.start
+        while segment.end - start > self.max_piece:
+            self._insert(SpeakerSegment(speaker=segment.speaker, start=start, end=start + self.max_piece))
+            start += self.max_piece
+        if start != segment.start:
+            segment = SpeakerSegment(speaker=segment.speaker, start=start, end=segment.end)
+        self._insert(segment)
+
+    def _insert(self, segment):
+        self.max_duration = max(self.max_duration, segment.end - segment.start)
+        if not self._starts or segment.start >= self._starts[-1]:
+            self._segments.append(segment)
+            self._starts.append(segment.start)
+        else:
+            # Out of order segments are rare, rebuild the lists so existing snapshots stay valid.
+            i = bisect_right(self._starts, segment.start, self._head)
+            self._segments = self._segments[:i] + [segment] + self._segments[i:]
+            self._starts = self._starts[:i] + [segment.start] + self._starts[i:]
+
+        if len(self) > self.max_segments:
+            self._head = len(self._segments) - self.max_segments
+        self._compact()
+
+    def drop_before(self, time):
+        """Drop the segments at the front of the store that ended before the given time."""
+        while self._head < len(self._segments) and self._segments[self._head].end < time:
+            self._head += 1
+        self._compact()
+
+    def _compact(self):
+        if self._head > 64 and self._head * 2 > len(self._segments):
+            self._segments = self._segments[self._head:]
+            self._starts = self._starts[self._head:]
+            self._head = 0
+
+    def snapshot(self):
+        return SegmentSnapshot(self._segments, self._starts, self._head, len(self._segments), self.max_duration)
+
+
 class DiarizationObserver(Observer):
     """Observer that logs all data emitted by the diarization pipeline and stores speaker segments."""
     
-    def __init__(self):
-        self.speaker_segments = []
+    def __init__(self, max_segments=4096):
+        self.speaker_segments = SegmentStore(max_segments)
         self.processed_time = 0
         self.segment_lock = threading.Lock()
     
@@ -45,7 +144,7 @@ class DiarizationObserver(Observer):
                 for speaker, label in annotation._labels.items():
                     for start, end in zip(label.segments_boundaries_[:-1], label.segments_boundaries_[1:]):
                         print(f"  {speaker}: {start:.2f}s-{end:.2f}s")
-                        self.speaker_segments.append(SpeakerSegment(
+                        self.speaker_segments.add(SpeakerSegment(
                             speaker=speaker,
                             start=start,
                             end=end
@@ -53,19 +152,15 @@ class DiarizationObserver(Observer):
             else:
                 logger.debug("\nNo speakers detected in this segment")
                 
-    def get_segments(self) -> List[SpeakerSegment]:
-        """Get a copy of the current speaker segments."""
+    def get_segments(self) -> SegmentSnapshot:
+        """Get a time-sorted snapshot of the current speaker segments."""
         with self.segment_lock:
-            return self.speaker_segments.copy()
+            return self.speaker_segments.snapshot()
     
     def clear_old_segments(self, older_than: float = 30.0):
         """Clear segments older than the specified time."""
         with self.segment_lock:
-            current_time = self.processed_time
-            self.speaker_segments = [
-                segment for segment in self.speaker_segments 
-                if current_time - segment.end < older_than
-            ]
+            self.speaker_segments.drop_before(self.processed_time - older_than)
     
     def on_error(self, error):
         """Handle an error in the stream."""
@@ -102,10 +197,136 @@ class WebSocketAudioSource(AudioSource):
             self.stream.on_next(new_audio)
 
 
+class DiarizationSession:
+    """
+    Per-session state of the shared DiarizationService: the session's own clustering and aggregation buffers (a
+    SpeakerDiarization built on the service's config, so it wraps the shared models without loading a copy) and the
+    audio not yet cut into chunks.
+    """
+
+    def __init__(self, service, observer):
+        self.service = service
+        self.observer = observer
+        self.pipeline = SpeakerDiarization(config=service.config)
+        self.pipeline.reset()
+        self._buffer = np.zeros(0, dtype=np.float32)
+        self._buffer_start = 0  # Sample index of the first sample in the buffer
+        self.closed = False
+
+    def push_audio(self, pcm: np.ndarray):
+        """Add audio and queue every full chunk (duration long, step apart) for the service's next batch."""
+        if self.closed:
+            return
+
+        self._buffer = np.concatenate([self._buffer, pcm.astype(np.float32)])
+        chunk, step, rate = self.service.chunk_samples, self.service.step_samples, self.service.sample_rate
+        while len(self._buffer) >= chunk:
+            window = SlidingWindow(start=self._buffer_start / rate, duration=1 / rate, step=1 / rate)
+            self.service.submit(self, SlidingWindowFeature(self._buffer[:chunk, np.newaxis].copy(), window))
+            self._buffer = self._buffer[step:]
+            self._buffer_start += step
+
+    def update(self, waveform, segmentation, embedding, resolution):
+        """Per-session part of SpeakerDiarization.__call__: clustering and aggregation of one chunk, runs on the service worker."""
+        pipeline = self.pipeline
+        window = SlidingWindow(start=waveform.extent.start, duration=resolution, step=resolution)
+        segmentation = SlidingWindowFeature(segmentation.cpu().numpy(), window)
+
+        permuted = pipeline.clustering(segmentation, embedding)
+        pipeline.chunk_buffer.append(waveform)
+        pipeline.pred_buffer.append(permuted)
+        agg_waveform = pipeline.audio_aggregation(pipeline.chunk_buffer)
+        agg_prediction = pipeline.binarize(pipeline.pred_aggregation(pipeline.pred_buffer))
+        if len(pipeline.chunk_buffer) == pipeline.pred_aggregation.num_overlapping_windows:
+            pipeline.chunk_buffer = pipeline.chunk_buffer[1:]
+            pipeline.pred_buffer = pipeline.pred_buffer[1:]
+
+        self.observer.on_next((agg_prediction, agg_waveform))
+
+    def close(self):
+        self.closed = True
+        self.observer.on_completed()
+
+
+class DiarizationService:
+    """
+    Speaker diarization for many sessions with a single copy of the segmentation and embedding models.
+
+    Every session keeps its own clustering state (DiarizationSession), but the chunks of all sessions are batched through
+    the shared models on one worker thread, instead of one pipeline, one StreamingInference and one blocked thread per session.
+
+    Args:
+        config (SpeakerDiarizationConfig, optional): Shared pipeline config, holding the models.
+        max_batch_size (int): Maximum number of chunks per model call.
+        max_wait (float): Maximum time in seconds a chunk waits for others to join its batch.
+    """
+
+    def __init__(self, config: SpeakerDiarizationConfig = None, max_batch_size: int = 16, max_wait: float = 0.05):
+        self.config = config or SpeakerDiarizationConfig()
+        self.models = SpeakerDiarization(config=self.config)
+        self.sample_rate = self.config.sample_rate
+        self.chunk_samples = int(round(self.config.duration * self.sample_rate))
+        self.step_samples = int(round(self.config.step * self.sample_rate))
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self._chunks = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="diarization-service", daemon=True)
+        self._worker.start()
+
+    def open_session(self, observer: DiarizationObserver) -> DiarizationSession:
+        return DiarizationSession(self, observer)
+
+    def submit(self, session: DiarizationSession, chunk: SlidingWindowFeature):
+        self._chunks.put((session, chunk))
+
+    def _collect(self):
+        batch = [self._chunks.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._chunks.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = [(session, chunk) for session, chunk in self._collect() if not session.closed]
+            if not batch:
+                continue
+            try:
+                self._process(batch)
+            except Exception as e:
+                logger.exception("Batched diarization failed")
+                for session, _ in batch:
+                    session.observer.on_error(e)
+
+    def _process(self, batch):
+        waveforms = torch.stack([torch.from_numpy(chunk.data) for _, chunk in batch])
+        segmentations = self.models.segmentation(waveforms)
+        embeddings = self.models.embedding(waveforms, segmentations)
+        resolution = batch[0][1].extent.duration / segmentations.shape[1]
+
+        # Chunks of one session stay in order within the batch, so its clustering sees them in time order.
+        for (session, chunk), segmentation, embedding in zip(batch, segmentations, embeddings):
+            session.update(chunk, segmentation, embedding, resolution)
+
+
 class DiartDiarization:
-    def __init__(self, sample_rate: int = 16000, config : SpeakerDiarizationConfig = None, use_microphone: bool = False):
-        self.pipeline = SpeakerDiarization(config=config)        
+    def __init__(self, sample_rate: int = 16000, config : SpeakerDiarizationConfig = None, use_microphone: bool = False, service: DiarizationService = None):
         self.observer = DiarizationObserver()
+        self.service_session = None
+
+        # With a shared service the session only holds its clustering state, no pipeline, inference or thread of its own.
+        if service is not None and not use_microphone:
+            self.service_session = service.open_session(self.observer)
+            self.custom_source = self.service_session
+            return
+
+        self.pipeline = SpeakerDiarization(config=config)        
         
         if use_microphone:
             self.source = MicrophoneAudioSource()
@@ -138,16 +359,40 @@ class DiartDiarization:
         if self.custom_source:
             self.custom_source.close()
 
+    def speaker_at(self, start: float, end: float):
+        """Speaker number with the most overlap with the given time range, or None if no segment overlaps it."""
+        segments = self.observer.get_segments()
+        overlap = {}
+        i = segments.start_index(start) if len(segments) else 0
+        while i < len(segments) and segments[i].start < end:
+            segment = segments[i]
+            if segment.end > start:
+                speaker = extract_number(segment.speaker) + 1
+                overlap[speaker] = overlap.get(speaker, 0) + min(end, segment.end) - max(start, segment.start)
+            i += 1
+        return max(overlap, key=overlap.get) if overlap else None
+
     def assign_speakers_to_tokens(self, end_attributed_speaker, tokens: list) -> float:
         """
         Assign speakers to tokens based on timing overlap with speaker segments.
-        Uses the segments collected by the observer.
+        Uses the segments collected by the observer. Tokens and segments are both in time order, so this is a single
+        merge-style pass: the first candidate segment only moves forward as the tokens advance.
         """
         segments = self.observer.get_segments()
-        
+        if not tokens or not len(segments):
+            return end_attributed_speaker
+
+        first = segments.start_index(tokens[0].start)
         for token in tokens:
-            for segment in segments:
-                if not (segment.end <= token.start or segment.start >= token.end):
+            # Skip segments that end before this token, no later token can overlap them either.
+            while first < len(segments) and segments[first].start + segments.max_duration <= token.start:
+                first += 1
+
+            i = first
+            while i < len(segments) and segments[i].start < token.end:
+                segment = segments[i]
+                if segment.end > token.start:
                     token.speaker = extract_number(segment.speaker) + 1
                     end_attributed_speaker = max(token.end, end_attributed_speaker)
+                i += 1
         return end_attributed_speaker
\ No newline at end of file
@@ -2,41 +2,146 @@
 from transformers import AutoImageProcessor, AutoModelForImageClassification
 import torch
 import numpy as np
+import os
+import time
+
+MODEL_NAME = os.getenv("FACIAL_MODEL", "dima806/facial_emotions_image_detection")
+
+# Inference backend: "torch" (fp32 eager), "int8" (dynamically quantized linear layers) or "onnx" (ONNX Runtime on an exported graph).
+BACKEND = os.getenv("FACIAL_BACKEND", "torch")
+ONNX_PATH = os.getenv("FACIAL_ONNX_PATH", os.path.join(os.path.dirname(__file__), "saves", "facial_emotions.onnx"))
+# Maximum difference in any class probability against the fp32 model before the backend is reported as diverging.
+PARITY_TOLERANCE = float(os.getenv("FACIAL_PARITY_TOLERANCE", 0.02))
 
-# Initialize processor and model once at module level
 device = "cuda" if torch.cuda.is_available() else "cpu"
-processor = AutoImageProcessor.from_pretrained("dima806/facial_emotions_image_detection", use_fast=True)
-model = AutoModelForImageClassification.from_pretrained("dima806/facial_emotions_image_detection")
+
+# Set by load(), main.py loads the model in the background instead of on import.
+processor = None
+model = None
+infer = None
+id2label = None
 
 def top_k(arr, k=3):
-    """Return the top k elements and their indices from a numpy array."""
-    import heapq
+    """Return the top k values and their indices along the last axis, highest first. Works on a single array or a batch."""
+    arr = np.asarray(arr)
+    k = min(k, arr.shape[-1])
 
-    heap = []
+    idx = np.argpartition(arr, -k, axis=-1)[..., -k:]
+    values = np.take_along_axis(arr, idx, axis=-1)
 
-    for i, p in enumerate(arr):
-        heapq.heappush(heap, (p, i))
-        if len(heap) > k:
-            heapq.heappop(heap)
+    order = np.argsort(-values, axis=-1)
+    return np.take_along_axis(values, order, axis=-1), np.take_along_axis(idx, order, axis=-1)
 
-    return sorted(heap, key=lambda x: x[0], reverse=True)
+def softmax(logits):
+    e = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
 
-def predict(image):
-    """Return a classification result for a given image from the webcam image"""
+def _torch_backend(net):
+    def infer(pixel_values):
+        with torch.inference_mode():
+            return net(pixel_values=torch.from_numpy(pixel_values)).logits.numpy()
+    return infer
+
+class _LogitsOnly(torch.nn.Module):
+    """Wrapper exporting only the logits, the HF output object can't be traced to ONNX."""
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, pixel_values):
+        return self.net(pixel_values=pixel_values).logits
+
+def _onnx_backend(sample):
+    import onnxruntime as ort
+
+    if not os.path.exists(ONNX_PATH):
+        print(f"Exporting facial model to {ONNX_PATH}")
+        os.makedirs(os.path.dirname(ONNX_PATH), exist_ok=True)
+        torch.onnx.export(
+            _LogitsOnly(model), (torch.from_numpy(sample),), ONNX_PATH,
+            input_names=["pixel_values"], output_names=["logits"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "logits": {0: "batch"}},
+            opset_version=17,
+        )
+
+    session = ort.InferenceSession(ONNX_PATH, providers=["CPUExecutionProvider"])
+    return lambda pixel_values: session.run(["logits"], {"pixel_values": pixel_values})[0]
+
+def load_backend(backend, sample):
+    """Build the inference function of a backend, returning fp32 logits for a batch of pixel values."""
+    if backend == "int8":
+        return _torch_backend(torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8))
+    if backend == "onnx":
+        return _onnx_backend(sample)
+    return _torch_backend(model)
+
+def _warmup_sample():
+    """A fixed synthetic frame, used for the warmup inference and the parity check."""
+    from PIL import Image
+
+    rng = np.random.default_rng(0)
+    image = Image.fromarray(rng.integers(0, 256, size=(224, 224, 3), dtype=np.uint8))
+    return processor(images=[image], return_tensors="np")["pixel_values"].astype(np.float32)
+
+def check_parity(infer, sample):
+    """Compare a backend's output with the fp32 eager model, returns the max probability difference and whether the top labels agree."""
+    reference = softmax(_torch_backend(model)(sample))
+    probs = softmax(infer(sample))
+
+    diff = float(np.abs(reference - probs).max())
+    same_labels = bool((top_k(reference)[1] == top_k(probs)[1]).all())
+    return diff, same_labels
+
+def load():
+    """Load the processor and the model and build the inference backend, falling back to torch if the backend fails."""
+    global processor, model, infer, id2label, BACKEND
+
+    processor = AutoImageProcessor.from_pretrained(MODEL_NAME, use_fast=True)
+    model = AutoModelForImageClassification.from_pretrained(MODEL_NAME).eval()
+    id2label = model.config.id2label
+
+    sample = _warmup_sample()
     try:
-        inputs = processor(images=image, return_tensors="pt")
+        infer = load_backend(BACKEND, sample)
+    except Exception as e:
+        print(f"Error loading facial backend {BACKEND}, falling back to torch: {e}")
+        BACKEND = "torch"
+        infer = load_backend(BACKEND, sample)
+
+def warmup():
+    """Warmup so the first real frame doesn't pay for allocation and kernel selection, then check the backend against fp32."""
+    global model
+
+    sample = _warmup_sample()
+    start = time.perf_counter()
+    infer(sample)
+    print(f"Facial backend {BACKEND} warmed up in {time.perf_counter() - start:.3f}s")
+
+    if BACKEND != "torch":
+        diff, same_labels = check_parity(infer, sample)
+        if diff > PARITY_TOLERANCE or not same_labels:
+            print(f"Warning: facial backend {BACKEND} diverges from fp32 (max probability difference {diff:.4f}, same top labels: {same_labels})")
+
+        # The fp32 weights are only needed for the export and the parity check.
+        model = None
 
-        with torch.no_grad():
-            logits = model(**inputs, return_dict=True).logits
+def predict_batch(images):
+    """Return the top 3 (probability, label) pairs for each image, with one processor and model call for the whole batch"""
+    inputs = processor(images=images, return_tensors="np")
 
-        top = top_k(logits.softmax(dim=1).squeeze().cpu().numpy(), k=3)
+    probs = softmax(infer(inputs["pixel_values"].astype(np.float32)))
 
-        top = [(prob.item(), model.config.id2label[idx]) for prob, idx in top]
+    values, indices = top_k(probs, k=3)
+
+    return [[(prob.item(), id2label[idx.item()]) for prob, idx in zip(row_values, row_indices)] for row_values, row_indices in zip(values, indices)]
+
+def predict(image):
+    """Return a classification result for a given image from the webcam image"""
+    try:
+        top = predict_batch([image])[0]
 
     except Exception as e:
         print(f"Error during prediction: {e}")
         return "Error during prediction"
 
     return top
-
-
@@ -3,6 +3,10 @@ from langchain_core.tools import Tool, tool
 from langgraph.prebuilt import create_react_agent, ToolNode
 from langchain_community.chat_models import ChatLlamaCpp
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import time
 import os
 
 load_dotenv("/data/qbui2/proj/dev/realtime-llm-eval/.env")
@@ -11,17 +15,198 @@ from langchain_community.utilities import GoogleSerperAPIWrapper
 
 # TODO: Had to rewrote a lot of the ChatLlamaCpp class from LangChain, and use a non-merge PR for llama-cpp-python to use "auto" tool choice. Reminder to keep the libraries up to date. 
 
-try:
-    
+# "llamacpp" runs the GGUF model, "fake" streams a canned answer at a fixed rate so the server can be load tested without a GPU.
+LLM_BACKEND = os.getenv("LLM_BACKEND", "llamacpp")
+MODEL_PATH = os.getenv("LLM_MODEL_PATH", "/data/qbui2/proj/dev/realtime-llm-eval/server/models/saves/medgemma-27b-text-it-Q6_K.gguf")
+FAKE_TOKEN_DELAY = float(os.getenv("LLM_FAKE_TOKEN_DELAY", 0.02))
+
+# llama.cpp parameters, n_gpu_layers=0 runs on CPU, e.g. to validate with small test models.
+N_CTX = int(os.getenv("LLM_N_CTX", 131072))
+N_BATCH = int(os.getenv("LLM_N_BATCH", 512))
+N_GPU_LAYERS = int(os.getenv("LLM_N_GPU_LAYERS", -1))
+
+# Speculative decoding: "" (off), "prompt_lookup" (drafts from n-grams of the prompt, e.g. transcript quotes) or "draft"
+# (a small GGUF with the same tokenizer, at LLM_DRAFT_MODEL_PATH). The main model verifies the drafted tokens in one batch.
+SPECULATIVE = os.getenv("LLM_SPECULATIVE", "")
+DRAFT_MODEL_PATH = os.getenv("LLM_DRAFT_MODEL_PATH")
+DRAFT_TOKENS = int(os.getenv("LLM_DRAFT_TOKENS", 8))
+DRAFT_N_GPU_LAYERS = int(os.getenv("LLM_DRAFT_N_GPU_LAYERS", N_GPU_LAYERS))
+# llama-cpp-python needs logits_all on the main model to verify drafts, which allocates an n_ctx x n_vocab float32 array
+# of scores in host memory: 32 GiB at n_ctx 32768 with Gemma's ~262k vocabulary, 128 GiB at the default 131072.
+# So the context is capped at LLM_SPECULATIVE_N_CTX while speculative decoding is on.
+SPECULATIVE_N_CTX = int(os.getenv("LLM_SPECULATIVE_N_CTX", 16384))
+
+FAKE_ANSWER = (
+    "Based on the transcription, the patient reports intermittent headaches over the past two weeks. "
+    "Consider asking about sleep, hydration and screen time, and check blood pressure before recommending further tests."
+)
+
+# Set by load(), main.py loads the model in the background instead of on import.
+llm = None
+agent = None
+kv_cache = None
+draft_model = None  # DraftStats around the draft model when speculative decoding is on
+
+
+class SessionKVCache:
+    """
+    Keeps a llama.cpp state snapshot (tokens + KV cache) per session, so a session's next turn only evaluates the part of its prompt that changed.
+    llama.cpp already skips the longest common token prefix between the loaded state and the new prompt, so restoring the session's own
+    snapshot before generating means the system message, the old transcript lines, etc. are not evaluated again.
+    Snapshots are evicted least recently used first once they exceed the memory budget.
+    Args:
+        client (llama_cpp.Llama): The underlying llama.cpp model.
+        capacity_bytes (int): Memory budget for all stored snapshots.
+    """
+
+    def __init__(self, client, capacity_bytes):
+        self.client = client
+        self.capacity_bytes = capacity_bytes
+        self.size_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "prefill_tokens": 0, "reused_tokens": 0, "evictions": 0}
+        self._states = OrderedDict()
+        self._owner = None  # Session whose tokens are currently in the llama.cpp context
+        self._lock = threading.Lock()  # Held for a whole generation, llama.cpp contexts are not thread safe
+        self._states_lock = threading.Lock()  # Guards the snapshots only, so drop() never waits on a generation
+
+    @contextmanager
+    def session(self, session_id):
+        """
+        Context manager around one generation for a session. Holds the model for the whole generation,
+        restores the session's snapshot on entry and saves the new one on exit.
+        Yields a dict where the caller counts the generated tokens under "generated".
+        """
+        from llama_cpp import Llama
+
+        with self._lock:
+            with self._states_lock:
+                state = self._states.get(session_id)
+
+            if self._owner == session_id:
+                self.stats["hits"] += 1
+            elif state is not None:
+                self.client.load_state(state)
+                self._owner = session_id
+                self.stats["hits"] += 1
+            else:
+                self.stats["misses"] += 1
+
+            before = self.client._input_ids.tolist()
+            turn = {"generated": 0}
+            try:
+                yield turn
+            finally:
+                after = self.client._input_ids.tolist()
+                reused = Llama.longest_token_prefix(before, after)
+                prefill = max(len(after) - reused - turn["generated"], 0)
+                self.stats["reused_tokens"] += reused
+                self.stats["prefill_tokens"] += prefill
+                print(f"KV cache for session {session_id}: reused {reused} tokens, prefilled {prefill} tokens")
+
+                self._store(session_id, self._snapshot())
+                self._owner = session_id
+
+    @contextmanager
+    def exclusive(self):
+        """Hold the model for work outside any session, e.g. transcript summaries. No session's tokens are loaded afterwards."""
+        with self._lock:
+            try:
+                yield
+            finally:
+                self._owner = None
+
+    @staticmethod
+    def _entry_bytes(state):
+        return state.llama_state_size + state.scores.nbytes + state.input_ids.nbytes
+
+    def _snapshot(self):
+        """
+        Llama.save_state() without its copy of the logits of every evaluated token, up to n_batch (or n_ctx with
+        logits_all) rows of n_vocab floats. Restoring the KV doesn't need them, load_state() only broadcasts the
+        stored scores over the restored rows, so only the last row is copied.
+        """
+        import ctypes
+        import llama_cpp
+
+        client = self.client
+        size = llama_cpp.llama_state_get_size(client._ctx.ctx)
+        data = (ctypes.c_uint8 * int(size))()
+        n_bytes = llama_cpp.llama_state_get_data(client._ctx.ctx, data, size)
+        if int(n_bytes) > int(size):
+            raise RuntimeError("Failed to copy llama state data")
+        return llama_cpp.LlamaState(
+            input_ids=client.input_ids.copy(),
+            scores=client._scores[-1:].copy(),
+            n_tokens=client.n_tokens,
+            llama_state=ctypes.string_at(data, int(n_bytes)),
+            llama_state_size=int(n_bytes),
+            seed=client._seed,
+        )
+
+    def _store(self, session_id, state):
+        with self._states_lock:
+            self._pop(session_id)
+            size = self._entry_bytes(state)
+            if size > self.capacity_bytes:
+                return
+
+            self._states[session_id] = state
+            self.size_bytes += size
+
+            while self.size_bytes > self.capacity_bytes:
+                _, evicted = self._states.popitem(last=False)
+                self.size_bytes -= self._entry_bytes(evicted)
+                self.stats["evictions"] += 1
+
+    def _pop(self, session_id):
+        state = self._states.pop(session_id, None)
+        if state is not None:
+            self.size_bytes -= self._entry_bytes(state)
+
+    def drop(self, session_id):
+        """Forget the snapshot of a session, e.g. when it disconnects."""
+        with self._states_lock:
+            self._pop(session_id)
+
+
+# Memory budget for the per-session KV snapshots, they hold the KV cache of every token in the session's last prompt.
+KV_CACHE_CAPACITY = int(os.getenv("LLM_KV_CACHE_BYTES", 8 * 1024 ** 3))
+
+
+
+def load():
+    """Load the LLM, or the fake one, and set up the session KV cache. Raises if the model can't be loaded."""
+    global llm, agent, kv_cache, draft_model
+
+    if LLM_BACKEND == "fake":
+        from langchain_core.language_models import FakeListChatModel
+
+        # Streams the answer one character per chunk, sleeping FAKE_TOKEN_DELAY before each.
+        llm = FakeListChatModel(responses=[FAKE_ANSWER], sleep=FAKE_TOKEN_DELAY)
+        return
+
+    model_kwargs = {}
+    n_ctx = N_CTX
+    if SPECULATIVE:
+        from models.speculative import make_draft_model
+
+        n_ctx = min(N_CTX, SPECULATIVE_N_CTX)
+        draft_model = make_draft_model(SPECULATIVE, DRAFT_TOKENS, DRAFT_MODEL_PATH, n_ctx=n_ctx, n_gpu_layers=DRAFT_N_GPU_LAYERS)
+        # Llama forces logits_all with a draft model but sizes scores from the argument, so it must be passed too.
+        model_kwargs["draft_model"] = draft_model
+        model_kwargs["logits_all"] = True
+        print(f"Speculative decoding ({SPECULATIVE}): context capped at {n_ctx} tokens for the logits_all scores")
+
     # Initialize the LLM model with the specified parameters.
-    llm = ChatLlamaCpp(
-        model_path="/data/qbui2/proj/dev/realtime-llm-eval/server/models/saves/medgemma-27b-text-it-Q6_K.gguf",
-        n_batch=512,
+    model = ChatLlamaCpp(
+        model_path=MODEL_PATH,
+        n_batch=N_BATCH,
         verbose=False,
-        n_ctx=131072, # Set up to 131072
-        n_gpu_layers=-1,
+        n_ctx=n_ctx, # Set up to 131072
+        n_gpu_layers=N_GPU_LAYERS,
         max_tokens=1024,
         temperature=0.1,
+        model_kwargs=model_kwargs,
     )
 
     # Search tool using SerpAPI
@@ -31,34 +216,97 @@ try:
     ]
 
     # Bind the tools to the LLM and create a ReAct agent.
-    llm_with_tools = llm.bind_tools(tools, tool_choice="auto") # This is not possible without the custom LlamaCpp class
+    llm_with_tools = model.bind_tools(tools, tool_choice="auto") # This is not possible without the custom LlamaCpp class
     agent = create_react_agent(llm_with_tools, tools=tools)
 
-except Exception as e:
-    print(f"Error loading LLM model: {e}")
-    llm = None
+    kv_cache = SessionKVCache(model.client, KV_CACHE_CAPACITY)
+    llm = model
+
+
+def warmup():
+    """Evaluate a short prompt, so the first answer doesn't pay for CUDA kernel setup."""
+    if LLM_BACKEND != "fake":
+        llm.client.create_completion("Hello", max_tokens=1)
+
+
+SUMMARY_PROMPT = (
+    "You keep a running summary of a medical visit transcript for a clinical assistant. "
+    "Update the summary with the new part of the transcript. Keep symptoms, history, medications, answers to the clinician's "
+    "questions and anything the patient seemed unsure or worried about, drop small talk. Answer with the updated summary only."
+)
+
+
+def count_tokens(text):
+    """Number of tokens of a text with the model's tokenizer, estimated when no tokenizer is loaded."""
+    if llm is None or LLM_BACKEND == "fake":
+        return len(text) // 4 + 1
+    return len(llm.client.tokenize(text.encode("utf-8"), add_bos=False, special=False))
 
-def llm_answer(question, history=None, context=None, emotions=None, patient_info=None):
+
+def summarize(previous_summary, transcript, max_tokens=512):
+    """Fold a part of the transcript into the running summary of a visit. Blocks until the model is free."""
+    if LLM_BACKEND == "fake":
+        # Roughly max_tokens of the most recent text, at the 4 characters per token count_tokens assumes.
+        return (previous_summary + " " + transcript).strip()[-max_tokens * 4:]
+
+    content = f"Current summary: {previous_summary or '(empty)'}\n\nNew part of the transcript:\n{transcript}"
+    with kv_cache.exclusive():
+        out = llm.client.create_chat_completion(
+            messages=[{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": content}],
+            max_tokens=max_tokens,
+            temperature=0.1,
+        )
+    return out["choices"][0]["message"]["content"].strip()
+
+
+def _speculative_stream(stream):
+    """Pass an answer through, then report the draft acceptance rate and speed of speculative decoding for it."""
+    draft_model.reset()
+    before = draft_model.snapshot()
+    start = time.perf_counter()
+    tokens = 0
+    try:
+        for chunk in stream:
+            tokens += 1
+            yield chunk
+    finally:
+        # Closing the inner stream right away releases the KV cache session of the answer.
+        if hasattr(stream, "close"):
+            stream.close()
+        after = draft_model.snapshot()
+        turn = {k: after[k] - before[k] for k in after}
+        elapsed = time.perf_counter() - start
+        print(f"Speculative decoding ({SPECULATIVE}): accepted {turn['accepted']}/{turn['drafted']} drafted tokens "
+              f"({100 * draft_model.acceptance_rate(turn):.0f}%), {tokens / elapsed if elapsed else 0:.1f} tokens/s")
+
+
+def _cached_stream(session_id, messages):
+    """Stream an answer while holding the session's KV snapshot, the snapshot is saved even if the stream is closed early."""
+    with kv_cache.session(session_id) as turn:
+        for chunk in llm.stream(messages):
+            turn["generated"] += 1
+            yield chunk
+
+
+def llm_answer(question, history=None, context=None, emotions=None, patient_info=None, session_id=None):
     """
     Function to get an answer from the LLM model based on the question and optional history.
     Args:
         question (str): The question to ask the LLM.
         history (list, optional): A list of previous messages in the conversation.
-        context (str, optional): Additional context for the LLM.
-        emotions (dict, optional): List of detected emotions at different timestamps.
+        context (str, optional): The transcription of the visit so far.
+        emotions (str, optional): Detected emotions at different timestamps, already formatted (see SessionContext.emotion_lines).
         patient_info (dict, optional): Information about the patient.
+        session_id (str, optional): Session the question belongs to, used to reuse its KV cache between turns.
     Returns:
         Generator: A generator that yields messages from the LLM.
     """
 
-    emotion_context = f"The user across the dialogue has shown the following emotions: \n"
-
-    for emotion in emotions:
-        emotion_context += f"At time {emotion['time']} combination of:\n"
-        for e in emotion["emotions"]:
-            emotion_context += f" {e["name"]} with probability {e['score']:.2f}.\n"
-
-    emotion_context += "Combine this information with the timeline of the transcription to add details about possible underlying problems with the patient report.\n"
+    emotion_context = (
+        "The user across the dialogue has shown the following emotions: \n"
+        + emotions
+        + "Combine this information with the timeline of the transcription to add details about possible underlying problems with the patient report.\n"
+    ) if emotions else ""
 
 
     formatted_history = [
@@ -69,15 +317,25 @@ def llm_answer(question, history=None, context=None, emotions=None, patient_info
         for h in history
     ] if history else []
         
-    out = llm.stream([
+    # The transcription only grows during a visit, keeping it ahead of anything that changes between turns lets
+    # the KV cache reuse everything up to the previously seen transcript lines.
+    transcription_context = f"There's an ongoing conversation which has been transcribed: {context}" if context else "There is no transcription provided."
+
+    messages = [
             SystemMessage(content=f"You are a medical assistant that works alongside a clinical professional to provide medical recommendations based on the patient's symptoms and history. You are not a doctor, but you can provide useful information and recommendations to help the doctor make a decision. {("Here's some information to consider: " + str(patient_info)) if patient_info else ""}"),
-            HumanMessage(content=f"There's an ongoing conversation which has been transcribed: {context}" if context else "There is no transcription provided." + f"\n{emotion_context if emotions else ''}"),
+            HumanMessage(content=transcription_context + (f"\n{emotion_context}" if emotions else "")),
             AIMessage(content=f"Thank you for the information I'm now ready to give you personalized medical recommendations."),
 
             *(formatted_history),
             HumanMessage(content=question)
-        ],
-        # stream_mode="messages", # For token level streaming (not possible without custom _stream method in LlamaCpp class)
-    )
+        ]
+
+    if session_id is not None and kv_cache:
+        out = _cached_stream(session_id, messages)
+    else:
+        out = llm.stream(
+            messages,
+            # stream_mode="messages", # For token level streaming (not possible without custom _stream method in LlamaCpp class)
+        )
 
-    return out
\ No newline at end of file
+    return _speculative_stream(out) if draft_model else out
\ No newline at end of file
@@ -0,0 +1,151 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from utils.metrics import LLM_QUEUE_SECONDS
+
+# Priorities, lower runs first: chat answers before background work such as transcript summaries.
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class LLMJob:
+    """
+    One unit of work for the model, run on the scheduler's worker.
+    Args:
+        session_id: Session the job belongs to, jobs of one session run in order.
+        run (callable): Work to do on the worker thread.
+        priority (int): INTERACTIVE or BACKGROUND.
+        on_position (callable, optional): Called with the job's queue position whenever it changes, 0 once it starts.
+        on_cancel (callable, optional): Called when the job is cancelled before it started.
+    """
+
+    def __init__(self, session_id, run, priority=INTERACTIVE, on_position=None, on_cancel=None):
+        self.session_id = session_id
+        self.run = run
+        self.priority = priority
+        self.on_position = on_position
+        self.on_cancel = on_cancel
+        self.position = None
+        self.submitted_at = time.monotonic()
+
+
+class LLMScheduler:
+    """
+    Single owner of the model: every generation runs on one worker thread, one at a time, so llama.cpp is never used from two threads.
+
+    Each session has its own FIFO of jobs and the worker serves the sessions round-robin, so one clinician asking many
+    questions can't delay the others by more than one answer each. Background jobs only run when no chat answer is waiting.
+    Queued jobs can be cancelled, which frees their place at once.
+    """
+
+    def __init__(self):
+        self._queues = [OrderedDict() for _ in (INTERACTIVE, BACKGROUND)]  # Per priority: session -> deque of jobs, in round-robin order
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self.running = None
+        self.stats = {"completed": 0, "cancelled_queued": 0}
+        self._worker = threading.Thread(target=self._run, name="llm-scheduler", daemon=True)
+        self._worker.start()
+
+    def submit(self, session_id, run, priority=INTERACTIVE, on_position=None, on_cancel=None):
+        """Queue work for the worker (see LLMJob for the arguments), returns the job, e.g. to cancel it."""
+        job = LLMJob(session_id, run, priority, on_position, on_cancel)
+        with self._lock:
+            self._queues[job.priority].setdefault(job.session_id, deque()).append(job)
+            self._update_positions()
+            self._wakeup.notify()
+        return job
+
+    def call(self, fn, *args, session_id=None, priority=BACKGROUND):
+        """Run fn(*args) on the worker, returns a Future of its result."""
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.submit(session_id, run, priority, on_cancel=future.cancel)
+        return future
+
+    def cancel(self, job):
+        """Remove a job that hasn't started yet. Returns False if it is already running or done."""
+        with self._lock:
+            sessions = self._queues[job.priority]
+            queue = sessions.get(job.session_id)
+            if queue is None or job not in queue:
+                return False
+            queue.remove(job)
+            if not queue:
+                del sessions[job.session_id]
+            self.stats["cancelled_queued"] += 1
+            self._update_positions()
+
+        if job.on_cancel:
+            job.on_cancel()
+        return True
+
+    def queued(self):
+        with self._lock:
+            return sum(len(queue) for sessions in self._queues for queue in sessions.values())
+
+    def _next(self):
+        """Pop the next job: highest priority first, then the session at the head of the round-robin."""
+        for sessions in self._queues:
+            if sessions:
+                session_id, queue = next(iter(sessions.items()))
+                job = queue.popleft()
+                if queue:
+                    sessions.move_to_end(session_id)
+                else:
+                    del sessions[session_id]
+                return job
+        return None
+
+    def _update_positions(self):
+        """
+        Recompute the place in line of every queued job (1 runs next), and report the ones that changed.
+        Called with the lock held, so on_position callbacks must only hand the value off.
+        """
+        position = 0
+        for sessions in self._queues:
+            # Round-robin order: the first job of every session, then the second of every session, ...
+            queues = [list(queue) for queue in sessions.values()]
+            for depth in range(max(map(len, queues), default=0)):
+                for queue in queues:
+                    if depth < len(queue):
+                        position += 1
+                        self._report(queue[depth], position)
+
+    def _report(self, job, position):
+        if job.position != position:
+            job.position = position
+            if job.on_position:
+                job.on_position(position)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                job = self._next()
+                while job is None:
+                    self._wakeup.wait()
+                    job = self._next()
+                self.running = job
+                self._report(job, 0)
+                self._update_positions()
+
+            LLM_QUEUE_SECONDS.observe(time.monotonic() - job.submitted_at)
+            try:
+                job.run()
+            except Exception as e:
+                print(f"Error in LLM job of session {job.session_id}: {e}")
+
+            with self._lock:
+                self.running = None
+                self.stats["completed"] += 1
+                self._update_positions()
@@ -0,0 +1,100 @@
+import threading
+
+import numpy as np
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+
+class GGUFDraftModel(LlamaDraftModel):
+    """
+    Draft model for speculative decoding: a small GGUF sharing the main model's tokenizer greedily proposes the next tokens.
+    Keeps its own context and only evaluates the tokens that changed since its last call.
+    Args:
+        model_path (str): Path of the draft GGUF.
+        num_pred_tokens (int): Tokens proposed per call.
+        n_ctx (int): Context size, must cover the main model's prompts.
+        n_gpu_layers (int): Layers offloaded to the GPU, 0 runs the draft on CPU.
+    """
+
+    def __init__(self, model_path, num_pred_tokens=8, n_ctx=8192, n_gpu_layers=0, n_batch=512):
+        self.num_pred_tokens = num_pred_tokens
+        self.llama = Llama(model_path=model_path, n_ctx=n_ctx, n_gpu_layers=n_gpu_layers, n_batch=n_batch, verbose=False)
+
+    def __call__(self, input_ids, /, **kwargs):
+        llama = self.llama
+        tokens = input_ids.tolist()
+        if len(tokens) + self.num_pred_tokens > llama.n_ctx():
+            return np.array([], dtype=np.intc)
+
+        # Keep the shared prefix in the draft's KV cache, at least the last token is evaluated again to get its logits.
+        prefix = min(Llama.longest_token_prefix(llama._input_ids.tolist(), tokens), len(tokens) - 1)
+        llama.n_tokens = prefix
+        llama._ctx.kv_cache_seq_rm(-1, prefix, -1)
+        llama.eval(tokens[prefix:])
+
+        draft = []
+        eos = llama.token_eos()
+        n_vocab = llama.n_vocab()
+        for _ in range(self.num_pred_tokens):
+            # Without logits_all, eval() doesn't copy logits into llama.scores, the context only keeps those of the last token.
+            logits = np.ctypeslib.as_array(llama._ctx.get_logits_ith(-1), shape=(n_vocab,))
+            token = int(np.argmax(logits))
+            if token == eos:
+                break
+            draft.append(token)
+            llama.eval([token])
+        return np.array(draft, dtype=np.intc)
+
+
+class DraftStats(LlamaDraftModel):
+    """
+    Wraps a draft model to count proposed and accepted tokens.
+    llama-cpp-python calls the draft with the tokens kept so far: after a call proposing d tokens at length n, the next
+    call's length m means m - n - 1 drafts were accepted (the last token is the main model's own sample).
+    """
+
+    def __init__(self, draft_model):
+        self.draft_model = draft_model
+        self.stats = {"calls": 0, "drafted": 0, "accepted": 0}
+        self._last = None  # (input length, tokens drafted) of the previous call
+        self._lock = threading.Lock()
+
+    def __call__(self, input_ids, /, **kwargs):
+        draft = self.draft_model(input_ids, **kwargs)
+        with self._lock:
+            if self._last is not None:
+                length, drafted = self._last
+                if len(input_ids) > length:
+                    self.stats["accepted"] += min(max(len(input_ids) - length - 1, 0), drafted)
+            self.stats["calls"] += 1
+            self.stats["drafted"] += len(draft)
+            self._last = (len(input_ids), len(draft))
+        return draft
+
+    def reset(self):
+        """Forget the previous call, e.g. when a new prompt starts, so it isn't taken for acceptances."""
+        with self._lock:
+            self._last = None
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+    @staticmethod
+    def acceptance_rate(stats):
+        return stats["accepted"] / stats["drafted"] if stats["drafted"] else 0.0
+
+
+def make_draft_model(mode, num_pred_tokens, model_path=None, n_ctx=8192, n_gpu_layers=0):
+    """
+    Build the draft model of a speculative decoding mode, wrapped in DraftStats.
+    Args:
+        mode (str): "prompt_lookup" (n-gram lookup in the prompt, free, good when answers quote the transcript) or "draft" (small GGUF).
+    """
+    if mode == "prompt_lookup":
+        return DraftStats(LlamaPromptLookupDecoding(num_pred_tokens=num_pred_tokens))
+    if mode == "draft":
+        if not model_path:
+            raise ValueError("LLM_DRAFT_MODEL_PATH is required for the draft speculative mode")
+        return DraftStats(GGUFDraftModel(model_path, num_pred_tokens=num_pred_tokens, n_ctx=n_ctx, n_gpu_layers=n_gpu_layers))
+    raise ValueError(f"Unknown speculative decoding mode {mode}")
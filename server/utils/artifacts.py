@@ -0,0 +1,164 @@
+import os
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import Future
+
+FSYNC_POLICIES = ("never", "flush", "close")
+
+
+class ArtifactWriter:
+    """
+    Writes the per-session artifacts (video chunks, transcription, expression and chat logs) off the event loop.
+
+    Writes are queued to a single background thread that keeps one open handle per file, so live events never wait on
+    open()/makedirs or the disk. Buffered data is flushed every flush_interval seconds and when a session is closed.
+
+    Args:
+        root (str): Directory holding one folder per session.
+        flush_interval (float): Seconds between flushes of buffered data, 0 flushes after every write.
+        fsync (str): "never", "flush" to fsync on every flush, or "close" to fsync only when a session's files are closed.
+        buffer_size (int): Size in bytes of each file's write buffer.
+    """
+
+    def __init__(self, root="./videos", flush_interval=1.0, fsync="close", buffer_size=1 << 20):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FSYNC_POLICIES}, got {fsync}")
+
+        self.root = root
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.buffer_size = buffer_size
+        self._handles = {}  # (session, filename) -> open file
+        self._dirty = set()
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="artifact-writer", daemon=True)
+        self._worker.start()
+
+    def path(self, session, filename=""):
+        return os.path.join(self.root, str(session), filename)
+
+    def write(self, session, filename, data):
+        """Queue data (str or bytes) to be appended to a session file. Never blocks."""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._queue.put(("write", session, filename, data, None))
+
+    def flush(self, session=None):
+        """Flush a session's files, or all files. Returns a Future resolved once the data is on disk."""
+        future = Future()
+        self._queue.put(("flush", session, None, None, future))
+        return future
+
+    def close_session(self, session):
+        """Flush and close all files of a session. Returns a Future resolved once they are closed, later writes reopen them."""
+        future = Future()
+        self._queue.put(("close", session, None, None, future))
+        return future
+
+    def close_file(self, session, filename):
+        """Flush and close one file of a session, e.g. a completed video segment. Returns a Future resolved once it is closed."""
+        future = Future()
+        self._queue.put(("close_file", session, filename, None, future))
+        return future
+
+    def move(self, session, filename, new_session):
+        """
+        Move a session file into another session's folder, closed first, appended to the file there if it already exists.
+        Writes queued after the move go to the new folder. Returns a Future resolved once the file is moved.
+        """
+        future = Future()
+        self._queue.put(("move", session, filename, new_session, future))
+        return future
+
+    def close(self):
+        """Flush and close every file and stop the writer thread."""
+        future = Future()
+        self._queue.put(("stop", None, None, None, future))
+        return future
+
+    def _open(self, session, filename):
+        key = (session, filename)
+        if key not in self._handles:
+            os.makedirs(self.path(session), exist_ok=True)
+            self._handles[key] = open(self.path(session, filename), "ab", buffering=self.buffer_size)
+        return self._handles[key]
+
+    def _flush(self, keys, sync):
+        for key in keys:
+            f = self._handles.get(key)
+            if f is None:
+                continue
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+            self._dirty.discard(key)
+
+    def _close(self, keys):
+        self._flush(keys, self.fsync != "never")
+        for key in keys:
+            self._handles.pop(key).close()
+
+    def _move(self, session, filename, new_session):
+        if (session, filename) in self._handles:
+            self._close([(session, filename)])
+        src, dst = self.path(session, filename), self.path(new_session, filename)
+        if not os.path.exists(src):
+            return
+        os.makedirs(self.path(new_session), exist_ok=True)
+        if os.path.exists(dst):
+            with open(src, "rb") as f, open(dst, "ab") as out:
+                shutil.copyfileobj(f, out)
+            os.remove(src)
+        else:
+            os.replace(src, dst)
+
+    def _session_keys(self, session):
+        return [key for key in self._handles if session is None or key[0] == session]
+
+    def _handle(self, op, session, filename, data, future):
+        if op == "write":
+            self._open(session, filename).write(data)
+            self._dirty.add((session, filename))
+            if self.flush_interval <= 0:
+                self._flush([(session, filename)], self.fsync == "flush")
+        elif op == "flush":
+            self._flush(self._session_keys(session), self.fsync == "flush")
+        elif op == "close_file":
+            if (session, filename) in self._handles:
+                self._close([(session, filename)])
+        elif op == "move":
+            self._move(session, filename, data)
+        elif op in ("close", "stop"):
+            self._close(self._session_keys(session))
+
+    def _run(self):
+        next_flush = time.monotonic() + self.flush_interval
+        while True:
+            # With flush_interval 0 every write is flushed on the spot, so there is nothing to wake up for.
+            timeout = max(next_flush - time.monotonic(), 0.01) if self.flush_interval > 0 else None
+            try:
+                op, session, filename, data, future = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                op = None
+
+            if op is not None:
+                try:
+                    self._handle(op, session, filename, data, future)
+                except Exception as e:
+                    print(f"Error writing artifact for session {session}: {e}")
+                    if future:
+                        future.set_exception(e)
+                else:
+                    if future:
+                        future.set_result(None)
+                if op == "stop":
+                    return
+
+            if self.flush_interval > 0 and time.monotonic() >= next_flush:
+                try:
+                    self._flush(list(self._dirty), self.fsync == "flush")
+                except Exception as e:
+                    print(f"Error flushing artifacts: {e}")
+                next_flush = time.monotonic() + self.flush_interval
@@ -0,0 +1,71 @@
+import numpy as np
+
+# Wire formats a client can pick for its audio events when it sends start. float32 is the original raw format and always accepted.
+AUDIO_FORMATS = ("float32", "int16", "mulaw", "opus")
+
+SAMPLE_RATE = 16000
+
+
+def _mulaw_table():
+    """G.711 mu-law byte -> float32 sample lookup table."""
+    u = ~np.arange(256, dtype=np.uint8)
+    magnitude = (((u & 0x0F).astype(np.int32) << 3) + 0x84) << ((u & 0x70) >> 4)
+    samples = np.where(u & 0x80, 0x84 - magnitude, magnitude - 0x84)
+    return (samples / 32768).astype(np.float32)
+
+
+MULAW_TABLE = _mulaw_table()
+
+
+def decode_float32(data):
+    return np.frombuffer(data, dtype=np.float32)
+
+
+def decode_int16(data):
+    return np.frombuffer(data, dtype="<i2").astype(np.float32) / 32768
+
+
+def decode_mulaw(data):
+    return MULAW_TABLE[np.frombuffer(data, dtype=np.uint8)]
+
+
+class OpusDecoder:
+    """Stateful Opus decoder for one session, each audio event carries one packet or a list of packets."""
+
+    # Largest Opus frame (120 ms) at 16 kHz.
+    MAX_FRAME_SIZE = 1920
+
+    def __init__(self):
+        import opuslib
+
+        self.decoder = opuslib.Decoder(SAMPLE_RATE, 1)
+
+    def __call__(self, data):
+        packets = data if isinstance(data, list) else [data]
+        return np.concatenate([decode_int16(self.decoder.decode(bytes(packet), self.MAX_FRAME_SIZE)) for packet in packets])
+
+
+def supported_formats():
+    """Formats this server can decode, opus only when the codec is installed."""
+    try:
+        import opuslib
+    except Exception:
+        return [f for f in AUDIO_FORMATS if f != "opus"]
+    return list(AUDIO_FORMATS)
+
+
+def make_decoder(audio_format):
+    """
+    Build the decoder turning a session's audio events into the float32 PCM the ASR needs.
+    Args:
+        audio_format (str): One of supported_formats().
+    Returns:
+        callable: Decoder taking the audio_data payload of an audio event.
+    """
+    if audio_format == "int16":
+        return decode_int16
+    if audio_format == "mulaw":
+        return decode_mulaw
+    if audio_format == "opus":
+        return OpusDecoder()
+    return decode_float32
@@ -0,0 +1,107 @@
+import asyncio
+import time
+from collections import deque
+
+import numpy as np
+
+OVERFLOW_POLICIES = ("drop_oldest", "drop_newest")
+
+
+class AudioIngress:
+    """
+    Queue of PCM chunks between handle_audio and the transcription loop of one session.
+
+    The transcription loop takes everything queued at once, and only once at least min_samples of new audio are there,
+    instead of running one inference per 4096-sample chunk, or as soon as the queue is full. The queue is bounded by the amount of queued audio: when
+    inference falls behind, "drop_oldest" drops the oldest audio to keep latency bounded, "drop_newest" drops incoming audio.
+    Counters of received, processed and dropped samples give the session's lag.
+
+    Args:
+        max_seconds (float): Maximum amount of queued audio in seconds.
+        overflow (str): Overflow policy, one of OVERFLOW_POLICIES.
+        sample_rate (int): Sample rate of the PCM chunks.
+    """
+
+    def __init__(self, max_seconds=10.0, overflow="drop_oldest", sample_rate=16000):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"overflow must be one of {OVERFLOW_POLICIES}, got {overflow}")
+
+        self.max_samples = int(max_seconds * sample_rate)
+        self.overflow = overflow
+        self.sample_rate = sample_rate
+        self.queued_samples = 0
+        self.received_samples = 0
+        self.processed_samples = 0
+        self.dropped_samples = 0
+        self.closed = False
+        self.last_wait = 0.0         # Seconds the oldest chunk of the last get() waited in the queue
+        self._queued_since = None
+        self._chunks = deque()
+        self._ready = asyncio.Event()
+        self._min_samples = 0
+        self._full = False  # Audio was dropped since the last get(), the queue can't grow any further
+
+    def put(self, pcm):
+        """Queue a chunk, applying the overflow policy. Returns the number of samples dropped."""
+        self.received_samples += len(pcm)
+        dropped = 0
+
+        if self.overflow == "drop_newest" and self.queued_samples + len(pcm) > self.max_samples:
+            dropped = len(pcm)
+        else:
+            if not self._chunks:
+                self._queued_since = time.monotonic()
+            self._chunks.append(pcm)
+            self.queued_samples += len(pcm)
+            while self.queued_samples > self.max_samples and len(self._chunks) > 1:
+                oldest = self._chunks.popleft()
+                self.queued_samples -= len(oldest)
+                dropped += len(oldest)
+
+        self.dropped_samples += dropped
+        if dropped:
+            self._full = True
+        if self.queued_samples >= self._min_samples or self._full:
+            self._ready.set()
+        return dropped
+
+    def close(self):
+        """Wake up the consumer, which gets the remaining audio and then None."""
+        self.closed = True
+        self._ready.set()
+
+    async def get(self, min_samples=0):
+        """
+        Wait until at least min_samples are queued, or the queue is full, and return all queued audio as one array.
+        Once closed, returns whatever is left, then None.
+        """
+        self._min_samples = min_samples
+        while self.queued_samples < max(min_samples, 1) and not self.closed and not self._full:
+            self._ready.clear()
+            await self._ready.wait()
+
+        if not self._chunks:
+            return None
+
+        pcm = np.concatenate(self._chunks)
+        self.last_wait = time.monotonic() - self._queued_since
+        self._chunks.clear()
+        self.queued_samples = 0
+        self._full = False
+        return pcm
+
+    def mark_processed(self, samples):
+        self.processed_samples += samples
+
+    @property
+    def lag_seconds(self):
+        """Audio received but not yet through inference: queued plus in flight."""
+        return (self.received_samples - self.dropped_samples - self.processed_samples) / self.sample_rate
+
+    def stats(self):
+        return {
+            "queued_seconds": self.queued_samples / self.sample_rate,
+            "processed_seconds": self.processed_samples / self.sample_rate,
+            "dropped_seconds": self.dropped_samples / self.sample_rate,
+            "lag_seconds": self.lag_seconds,
+        }
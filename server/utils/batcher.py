@@ -0,0 +1,114 @@
+import asyncio
+import time
+
+
+class MicroBatcher:
+    """
+    Dynamic micro-batching front-end for a blocking batch function shared by all sessions.
+
+    Items submitted from any session are collected until max_batch_size is reached or the oldest one has waited max_wait,
+    then batch_fn runs once over the whole batch on the executor and each caller gets its own result back.
+    Only one batch runs at a time, items arriving meanwhile form the next batch. If the call over a batch fails, its items
+    are run again one by one, so only the callers of the items that fail on their own get the exception.
+
+    Args:
+        batch_fn (callable): Blocking function taking a list of items and returning a list of results in the same order.
+        executor (Executor): Executor batch_fn runs on.
+        max_batch_size (int): Maximum number of items per call.
+        max_wait (float): Maximum time in seconds an item waits for others before its batch runs.
+    """
+
+    def __init__(self, batch_fn, executor, max_batch_size=16, max_wait=0.02):
+        self.batch_fn = batch_fn
+        self.executor = executor
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.stats = {
+            "items": 0,
+            "batches": 0,
+            "busy_seconds": 0.0,     # Time spent inside batch_fn
+            "latency_seconds": 0.0,  # Sum over items of submit -> result time
+            "max_latency_seconds": 0.0,
+        }
+        self._pending = []  # (item, future, submitted_at)
+        self._timer = None
+        self._busy = False
+
+    async def submit(self, item):
+        """Queue an item and wait for its result."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future, time.perf_counter()))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        # The running batch flushes again when it finishes.
+        if self._busy or not self._pending:
+            return
+
+        batch = self._pending[:self.max_batch_size]
+        self._pending = self._pending[self.max_batch_size:]
+        self._busy = True
+        asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            try:
+                results = [(result, None) for result in await loop.run_in_executor(self.executor, self.batch_fn, [item for item, _, _ in batch])]
+            except Exception as e:
+                # Run the items again one by one, so only the callers of the items that fail on their own get an error.
+                results = [(None, e)] if len(batch) == 1 else [await self._run_one(item) for item, _, _ in batch]
+            for (_, future, _), (result, error) in zip(batch, results):
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+        finally:
+            end = time.perf_counter()
+            self.stats["items"] += len(batch)
+            self.stats["batches"] += 1
+            self.stats["busy_seconds"] += end - start
+            for _, _, submitted_at in batch:
+                self.stats["latency_seconds"] += end - submitted_at
+                self.stats["max_latency_seconds"] = max(self.stats["max_latency_seconds"], end - submitted_at)
+
+            self._busy = False
+            if len(self._pending) >= self.max_batch_size:
+                self._flush()
+            elif self._pending and self._timer is None:
+                # Leftovers have already waited through this batch, run them right away.
+                self._timer = loop.call_soon(self._flush)
+
+    async def _run_one(self, item):
+        """(result, None) of batch_fn over a single item, or (None, exception) if it fails."""
+        try:
+            return (await asyncio.get_running_loop().run_in_executor(self.executor, self.batch_fn, [item]))[0], None
+        except Exception as e:
+            return None, e
+
+    def summary(self):
+        """Throughput and latency figures for tuning max_batch_size and max_wait."""
+        items, batches = self.stats["items"], self.stats["batches"]
+        return {
+            "items": items,
+            "batches": batches,
+            "mean_batch_size": items / batches if batches else 0.0,
+            "items_per_second": items / self.stats["busy_seconds"] if self.stats["busy_seconds"] else 0.0,
+            "mean_latency_ms": 1000 * self.stats["latency_seconds"] / items if items else 0.0,
+            "max_latency_ms": 1000 * self.stats["max_latency_seconds"],
+            "pending": len(self._pending),
+        }
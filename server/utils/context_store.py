@@ -0,0 +1,64 @@
+import time
+from collections import deque
+
+
+def format_emotions(timestamp, emotions):
+    """Prompt lines of one facial emotion result, a list of (probability, label) pairs."""
+    lines = [f"At time {timestamp} combination of:\n"]
+    lines.extend(f" {label} with probability {prob:.2f}.\n" for prob, label in emotions)
+    return "".join(lines)
+
+
+class SessionContext:
+    """
+    What the LLM knows about a visit: the transcript, the latest facial emotions and the chat history.
+
+    Filled by the server as transcription, emotion and chat results come in, so a chat message only needs to carry its question.
+    Each piece is formatted once when it arrives and the prompt sections are built from the formatted pieces.
+
+    Args:
+        max_emotions (int): Number of most recent emotion results kept for the prompt.
+        max_history (int): Number of most recent chat messages (questions and answers) kept for the prompt.
+    """
+
+    def __init__(self, max_emotions=30, max_history=10):
+        self.lines = []  # [time, text] per minute of transcript, like the client shows it
+        self.emotions = deque(maxlen=max_emotions)  # Formatted prompt lines of each result
+        self.history = deque(maxlen=max_history)  # {"type": "User" | "AI", "content": ...}
+
+        # Rolling summary of the older transcript, maintained by the ContextBuilder.
+        self.line_tokens = []  # Token count of each finished line
+        self.summary = ""
+        self.summary_tokens = 0
+        self.summarized = 0  # Number of lines covered by the summary
+        self.summary_task = None
+
+    def add_transcript(self, text, speaker=None):
+        """Add a transcribed piece, joined to the current line while it's the same minute."""
+        now = time.strftime("%H:%M")
+        if speaker:
+            text = f"Speaker {speaker}: {text}"
+        if self.lines and self.lines[-1][0] == now:
+            self.lines[-1][1] += f" {text}"
+        else:
+            self.lines.append([now, text])
+
+    def add_emotions(self, emotions):
+        """Add a facial emotion result, a list of (probability, label) pairs."""
+        self.emotions.append(format_emotions(time.strftime("%H:%M:%S"), emotions))
+
+    def add_turn(self, question, answer):
+        """Record a completed chat turn. Interrupted answers are not recorded, like the client drops them."""
+        self.history.append({"type": "User", "content": question})
+        self.history.append({"type": "AI", "content": answer})
+
+    def finished_lines(self):
+        """Number of lines that won't change anymore, all but the last."""
+        return max(len(self.lines) - 1, 0)
+
+    def text(self, start, end=None):
+        """Text of the lines from start to end, one "time text" line per minute."""
+        return "\n".join(f"{timestamp} {text}" for timestamp, text in self.lines[start:end])
+
+    def emotion_lines(self):
+        return "".join(self.emotions)
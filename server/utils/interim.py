@@ -0,0 +1,46 @@
+def unconfirmed_text(online):
+    """
+    Current hypothesis of the words not committed yet.
+    Args:
+        online: VACOnlineASRProcessor or OnlineASRProcessor of whisper_streaming.
+    Returns:
+        tuple: (end of the last word in seconds from the start of recording or None, text or "").
+    """
+    # The VAC processor wraps the OnlineASRProcessor holding the hypothesis buffer.
+    processor = getattr(online, "online", online)
+    buffer = getattr(processor, "transcript_buffer", None)
+    if buffer is None:
+        return None, ""
+    words = buffer.complete()  # [(start, end, word), ...] transcribed once but not confirmed by the next iteration
+    if not words:
+        return None, ""
+    sep = getattr(getattr(processor, "asr", None), "sep", "")
+    return words[-1][1], sep.join(word for _, _, word in words).strip()
+
+
+class InterimTranscript:
+    """
+    Tracks the interim hypothesis last sent to a client and turns the next one into a stable-prefix diff.
+
+    The hypothesis mostly grows at its end or rewrites its last words, so only the tail after the prefix shared with the
+    previous hypothesis is sent: the client keeps the first `keep` characters of its interim text and appends `text`.
+    """
+
+    def __init__(self):
+        self.text = ""
+
+    def update(self, text):
+        """The diff {"keep": ..., "text": ...} from the last sent hypothesis to text, or None if it didn't change."""
+        if text == self.text:
+            return None
+        keep = 0
+        for a, b in zip(self.text, text):
+            if a != b:
+                break
+            keep += 1
+        self.text = text
+        return {"keep": keep, "text": text[keep:]}
+
+    def clear(self):
+        """Diff emptying the client's interim text, e.g. when the session stops, or None if it is already empty."""
+        return self.update("")
@@ -0,0 +1,137 @@
+import asyncio
+import threading
+import time
+
+# Sentinel marking the end of the token stream.
+_END = object()
+
+
+class LLMStream:
+    """
+    Bridge between a blocking LLM token generator and the asyncio event loop.
+
+    Generation runs on its own worker thread, or as a job of an LLMScheduler, and feeds an asyncio queue, so the event loop
+    only ever waits on the queue. Iterating the stream yields text grouped over a time/token window instead of one item per token.
+
+    Args:
+        answer_fn (callable): Function returning the token generator, e.g. llm_answer. Called on the worker thread.
+        *args: Arguments passed to answer_fn.
+        max_delay (float): Maximum time in seconds a token is held back waiting for more tokens to group with.
+        max_tokens (int): Maximum number of tokens grouped into one piece of text.
+        scheduler (LLMScheduler, optional): Scheduler running the generation, instead of a thread of its own.
+        session_id (optional): Session the stream belongs to, for the scheduler's per-session queues.
+        on_position (coroutine function, optional): Awaited on the event loop with the stream's queue position when it changes.
+    """
+
+    def __init__(self, answer_fn, *args, max_delay=0.05, max_tokens=16, scheduler=None, session_id=None, on_position=None):
+        self.answer_fn = answer_fn
+        self.args = args
+        self.max_delay = max_delay
+        self.max_tokens = max(1, max_tokens)
+        self.scheduler = scheduler
+        self.session_id = session_id
+        self.on_position = on_position
+        self.error = None
+        self.tokens = 0
+        self.started_at = None
+        self.first_token_at = None
+        self.finished_at = None
+        self._cancel = threading.Event()
+        self._queue = asyncio.Queue()
+        self._loop = None
+        self._worker = None
+        self._job = None
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def time_to_first_token(self):
+        """Seconds from start() to the first token, None if none was generated."""
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started_at
+
+    @property
+    def tokens_per_second(self):
+        """Generation speed after the first token, None until the stream has ended with at least two tokens."""
+        if self.finished_at is None or self.tokens < 2 or self.finished_at <= self.first_token_at:
+            return None
+        return (self.tokens - 1) / (self.finished_at - self.first_token_at)
+
+    def start(self):
+        """Start generating on the worker thread. Must be called from the event loop."""
+        self.started_at = time.monotonic()
+        self._loop = asyncio.get_running_loop()
+        if self.scheduler is not None:
+            self._job = self.scheduler.submit(self.session_id, self._generate, on_position=self._position, on_cancel=lambda: self._put(_END))
+            return
+        self._worker = threading.Thread(target=self._generate, name="llm-stream", daemon=True)
+        self._worker.start()
+
+    def cancel(self):
+        """
+        Stop generation on the worker, the stream ends after the token currently being decoded.
+        A stream still waiting in the scheduler's queue is removed from it and ends at once.
+        """
+        self._cancel.set()
+        if self._job is not None:
+            self.scheduler.cancel(self._job)
+
+    def _position(self, position):
+        if self.on_position is not None:
+            asyncio.run_coroutine_threadsafe(self.on_position(position), self._loop)
+
+    def _put(self, item):
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+
+    def _generate(self):
+        out = None
+        try:
+            # Cancelled while it was waiting for the model, don't even evaluate the prompt.
+            if self._cancel.is_set():
+                return
+            out = self.answer_fn(*self.args)
+            for chunk in out:
+                if self._cancel.is_set():
+                    break
+                # Chunk might also be a ToolMessageChunk from the search tool, which has no text to stream.
+                if chunk.content:
+                    if self.first_token_at is None:
+                        self.first_token_at = time.monotonic()
+                    self.tokens += 1
+                    self._put(chunk.content)
+        except Exception as e:
+            self.error = e
+        finally:
+            # Closing the generator stops llama.cpp from decoding the rest of the answer.
+            if out is not None and hasattr(out, "close"):
+                out.close()
+            self.finished_at = time.monotonic()
+            self._put(_END)
+
+    async def __aiter__(self):
+        loop = asyncio.get_running_loop()
+        done = False
+        while not done:
+            item = await self._queue.get()
+            if item is _END:
+                break
+
+            parts = [item]
+            deadline = loop.time() + self.max_delay
+            while len(parts) < self.max_tokens:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if item is _END:
+                    done = True
+                    break
+                parts.append(item)
+
+            yield "".join(parts)
@@ -0,0 +1,163 @@
+import threading
+from bisect import bisect_left
+
+# Latency buckets in seconds, from sub-millisecond calls up to slow LLM and REDCap requests.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Real-time factor buckets, processing time over audio duration, above 1 means transcription falls behind.
+RTF_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 5.0)
+# LLM generation speed buckets in tokens per second.
+TOKEN_RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 200)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Histogram:
+    """
+    Prometheus histogram. observe() is a bisect and a few additions under a lock, cheap enough for every event on the hot path.
+    Args:
+        name (str): Metric name.
+        help (str): Description shown in the exposition.
+        buckets (tuple[float]): Upper bounds of the buckets, +Inf is added.
+        labels (tuple[str]): Label names, values are given to observe() in the same order.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.labels = tuple(labels)
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            series[i] += 1
+            series[-1] += value
+
+    def render(self):
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+
+        lines = []
+        for label_values, values in series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values[:-1]):
+                cumulative += count
+                le = bound if bound == "+Inf" else _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {_format_value(values[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {cumulative}")
+        return lines
+
+
+class Counter:
+    """Monotonic Prometheus counter."""
+
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in values.items()]
+
+
+class Gauge:
+    """
+    Prometheus gauge read when the metrics are scraped, so keeping it current costs nothing on the hot path.
+    Args:
+        fn (callable): Returns the current value, or a dict of label values tuple -> value for a labelled gauge.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, help, fn, labels=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labels = tuple(labels)
+
+    def render(self):
+        value = self.fn()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(v)}" for key, v in value.items() if v is not None]
+
+
+class MetricsRegistry:
+    """Collection of metrics rendered together in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        return self._register(Histogram(name, help, buckets, labels))
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, fn, labels=()):
+        return self._register(Gauge(name, help, fn, labels))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                samples = metric.render()
+            except Exception as e:
+                # A failing gauge callback must not take the whole scrape down.
+                print(f"Error collecting metric {metric.name}: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# Hot-path metrics shared by the server modules, gauges are registered by main.py where the objects they read live.
+TRANSCRIBE_QUEUE_WAIT = registry.histogram("transcribe_queue_wait_seconds", "Time audio waits in a session's queue before it is taken for transcription.")
+PROCESS_ITER_SECONDS = registry.histogram("transcribe_process_iter_seconds", "Duration of one process_iter call, including the wait for its ASR batch.")
+TRANSCRIBE_RTF = registry.histogram("transcribe_real_time_factor", "process_iter duration over the duration of the audio it processed.", buckets=RTF_BUCKETS)
+PREDICT_SECONDS = registry.histogram("facial_predict_seconds", "Facial emotion prediction latency of one frame, including the wait for its batch.")
+LLM_TTFT_SECONDS = registry.histogram("llm_time_to_first_token_seconds", "Time from a chat message to the first generated token.")
+LLM_QUEUE_SECONDS = registry.histogram("llm_queue_wait_seconds", "Time an LLM job (answer or summary) waits for the model.")
+LLM_TOKENS_PER_SECOND = registry.histogram("llm_tokens_per_second", "Generation speed of an answer after its first token.", buckets=TOKEN_RATE_BUCKETS)
+ASR_GATE_SECONDS = registry.counter("asr_gate_audio_seconds_total", "Seconds of audio the speech gate passed to transcription or skipped as silence.", labels=("decision",))
+REDCAP_SECONDS = registry.histogram("redcap_request_seconds", "Latency of REDCap API calls.", labels=("content", "status"))
@@ -0,0 +1,109 @@
+import asyncio
+import threading
+import time
+import traceback
+
+
+class LoadingModel:
+    """Load state (pending, loading, warming_up, ready or failed) and timings of one model."""
+
+    def __init__(self, name, load, warmup=None):
+        self.name = name
+        self.load = load
+        self.warmup = warmup
+        self.state = "pending"
+        self.error = None
+        self.load_seconds = None
+        self.warmup_seconds = None
+        self.done = threading.Event()
+        self._waiters = []  # (loop, future) of the coroutines waiting in wait()
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    def status(self):
+        return {
+            "state": self.state,
+            "load_seconds": self.load_seconds,
+            "warmup_seconds": self.warmup_seconds,
+            "error": self.error,
+        }
+
+
+class ModelLoader:
+    """
+    Loads the server's models in background threads, all at once, so the server can bind and answer while they load.
+
+    Each model has a load function and an optional warmup function running one inference, so the first real request
+    doesn't pay for kernel selection and JIT setup. Handlers check ready() to degrade, or await wait() to queue until a model is warm.
+    """
+
+    def __init__(self):
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, load, warmup=None):
+        self._models[name] = LoadingModel(name, load, warmup)
+
+    def start(self):
+        """Start loading every pending model, each on its own thread."""
+        for model in self._models.values():
+            if model.state == "pending":
+                model.state = "loading"
+                threading.Thread(target=self._load, args=(model,), name=f"load-{model.name}", daemon=True).start()
+
+    def _load(self, model):
+        try:
+            start = time.perf_counter()
+            model.load()
+            model.load_seconds = round(time.perf_counter() - start, 3)
+            print(f"Loaded {model.name} in {model.load_seconds:.1f}s")
+
+            if model.warmup:
+                model.state = "warming_up"
+                start = time.perf_counter()
+                model.warmup()
+                model.warmup_seconds = round(time.perf_counter() - start, 3)
+            model.state = "ready"
+        except Exception as e:
+            traceback.print_exc()
+            print(f"Error loading {model.name}: {e}")
+            model.error = str(e)
+            model.state = "failed"
+        finally:
+            with self._lock:
+                model.done.set()
+                waiters, model._waiters = model._waiters, []
+            for loop, future in waiters:
+                loop.call_soon_threadsafe(_wake, future)
+
+    def ready(self, name=None):
+        """Whether a model, or every model, is loaded and warm."""
+        if name is None:
+            return all(model.ready for model in self._models.values())
+        return self._models[name].ready
+
+    async def wait(self, name, timeout=None):
+        """Wait until a model has finished loading, up to timeout seconds. Returns whether it is ready."""
+        model = self._models[name]
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if model.done.is_set():
+                return model.ready
+            model._waiters.append((loop, future))
+
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        return model.ready
+
+    def status(self):
+        return {name: model.status() for name, model in self._models.items()}
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
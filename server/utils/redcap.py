@@ -1,119 +1,289 @@
-import requests
+import asyncio
+import time
+import httpx
 import dotenv
 import os
+import uuid
 
-dotenv.load_dotenv("/data/qbui2/proj/dev/realtime-llm-eval/.env")
-
-URL = "https://redcap.times.uh.edu/api/"
-
-
-def list_folders(folder_id=''):
-    data = {
-        'token': os.getenv("REDCAP"),
-        'content': 'fileRepository',
-        'action': 'list',
-        'format': 'json',
-        'folder_id': folder_id,
-        'returnFormat': 'json'
-    }
-    r = requests.post(URL, data=data)
+from utils.metrics import REDCAP_SECONDS
 
-    return r.json()
+dotenv.load_dotenv("/data/qbui2/proj/dev/realtime-llm-eval/.env")
 
-
-def create_folder(folder_name):
-    data = {
-        'token': os.getenv("REDCAP"),
-        'content': 'fileRepository',
-        'action': 'createFolder',
-        'format': 'json',
-        'name': folder_name,
-        'folder_id': '',
-        'returnFormat': 'json'
-    }
-    r = requests.post(URL, data=data)
-    print(f"Created new folder: {folder_name}\n")
-    return r.json()[0]['folder_id']
-
-def upload_file(file_path, patient_name):
-    """Upload a file to REDCAP under a specific patient's folder."""
-    print(f"Uploading file {file_path} for patient {patient_name}")
-    folders = list_folders()
-
-    if patient_name not in set([folder['name'] for folder in folders if "folder_id" in folder]):
-        folder_id = create_folder(patient_name)
-    else:
-        folder_id = get_id_from_name(patient_name)
-
-    params = {
-        "token": os.getenv("REDCAP"),
-        "content": "fileRepository",
-        "action": "import",
-        "folder_id": folder_id,
-        "returnFormat": "json"
-    }
-    with open(file_path, "rb") as f:
-
-        files = {
-            'file': (file_path, f)
-        }
-        response = requests.post(URL, data=params, files=files)
-        print(response.text)
-
-def get_file(doc_id):
-    """Fetch a base64 encoded file from REDCAP given a document ID."""
-
-    data = {
-        'token': os.getenv("REDCAP"),
-        'content': 'fileRepository',
-        'action': 'export',
-        'format': 'json',
-        'doc_id': doc_id,
-        'returnFormat': 'json'
-    }
-    r = requests.post(URL, data=data)
-    return r.content
-
-def delete_document(doc_id):
-    """Delete a document from REDCAP given a document ID."""
-    data = {
-        'token': os.getenv("REDCAP"),
-        'content': 'fileRepository',
-        'action': 'delete',
-        'doc_id': doc_id,
-        'returnFormat': 'json'
-    }
-    r = requests.post(URL, data=data)
-    print(r)
-    
-
-def delete_data(folder_id):
-    """Delete all documents in a folder."""
-    files = list_folders(folder_id)
-    
-    for file in files:
-        if 'doc_id' in file:
-            delete_document(file['doc_id'])
-
-def get_id_from_name(name):
-    """Get the document ID from the file name."""
-    folders = list_folders()
-    for folder in folders:
-        if folder['name'] == name:
-            return folder['folder_id']
-    return None
-
-def list_records(records=[]):
-    """List all records in REDCAP."""
-    data = {
-        'token': os.getenv("REDCAP"),
-        'content': 'record',
-        'format': 'json',
-        'returnFormat': 'json',
-        "records": records
-    }
-    r = requests.post(URL, data=data)
-    return r.json()
+URL = os.getenv("REDCAP_URL", "https://redcap.times.uh.edu/api/")
+
+
+class RedcapClient:
+    """
+    Async REDCap API client shared by the routes and the socket handlers.
+    Keeps a pool of keep-alive connections, puts a timeout on every call and caches exported records per record ID.
+    Args:
+        url (str): REDCap API endpoint, point it at a local stand-in server for testing.
+        token (str, optional): API token, defaults to the REDCAP environment variable.
+        timeout (float): Timeout in seconds for each request.
+        max_connections (int): Size of the connection pool.
+        ttl (float): Time in seconds an exported record stays cached.
+    """
+
+    def __init__(self, url=URL, token=None, timeout=10.0, max_connections=10, ttl=300.0):
+        self.url = url
+        self.token = token or os.getenv("REDCAP")
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.ttl = ttl
+        self._client = None
+        self._records = {}  # record -> (expires_at, parsed record)
+        self._pending = {}  # record -> in-flight fetch shared by concurrent callers
+        self._folder_ids = None  # name -> folder_id of the top level folders, loaded on first use
+        self._folder_lock = asyncio.Lock()
+
+    def _http(self):
+        # Created lazily so it binds to the running event loop.
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _post(self, data, files=None, content=None, headers=None):
+        """POST an API call. With content (a prebuilt body, e.g. a streamed upload), data only labels the call's metrics."""
+        data = {'token': self.token, 'returnFormat': 'json', **data}
+        start = time.monotonic()
+        status = "error"
+        try:
+            if content is not None:
+                r = await self._http().post(self.url, content=content, headers=headers)
+            else:
+                r = await self._http().post(self.url, data=data, files=files)
+            status = str(r.status_code)
+            r.raise_for_status()
+            return r
+        finally:
+            REDCAP_SECONDS.observe(time.monotonic() - start, data.get('content', ''), status)
+
+    async def list_folders(self, folder_id=''):
+        r = await self._post({
+            'content': 'fileRepository',
+            'action': 'list',
+            'format': 'json',
+            'folder_id': folder_id,
+        })
+        return r.json()
+
+    async def create_folder(self, folder_name):
+        r = await self._post({
+            'content': 'fileRepository',
+            'action': 'createFolder',
+            'format': 'json',
+            'name': folder_name,
+            'folder_id': '',
+        })
+        print(f"Created new folder: {folder_name}\n")
+        folder_id = r.json()[0]['folder_id']
+        if self._folder_ids is not None:
+            self._folder_ids[folder_name] = folder_id
+        return folder_id
+
+    async def _load_folder_index(self):
+        folders = await self.list_folders()
+        self._folder_ids = {folder['name']: folder['folder_id'] for folder in folders if "folder_id" in folder}
+
+    async def folder_id(self, name, create=False):
+        """
+        Get the folder ID of a top level folder from the cached name index.
+        The index is reloaded once on a miss in case the folder was created elsewhere.
+        Args:
+            name (str): Folder name, the patient's record ID.
+            create (bool): Create the folder if it doesn't exist.
+        Returns:
+            The folder ID, or None if it doesn't exist and create is False.
+        """
+        if self._folder_ids is not None and name in self._folder_ids:
+            return self._folder_ids[name]
+
+        async with self._folder_lock:
+            await self._load_folder_index()
+            if name not in self._folder_ids and create:
+                await self.create_folder(name)
+            return self._folder_ids.get(name)
+
+    async def upload_file(self, file_path, patient_name):
+        """Upload a file to REDCAP under a specific patient's folder."""
+        print(f"Uploading file {file_path} for patient {patient_name}")
+        folder_id = await self.folder_id(patient_name, create=True)
+        await self.import_file(file_path, folder_id)
+
+    async def import_file(self, file_path, folder_id, name=None, limiter=None, chunk_size=1 << 16, start=0, end=None):
+        """
+        Upload a file into a file repository folder, streamed from disk in chunks instead of read whole into memory.
+        Args:
+            file_path (str): File to upload.
+            folder_id: Folder of the file repository.
+            name (str, optional): File name in REDCap, defaults to the file's base name.
+            limiter (RateLimiter, optional): Bandwidth cap shared with other uploads, awaited before each chunk is sent.
+            chunk_size (int): Bytes read and sent at a time.
+            start (int): Offset of the first byte to upload, to upload only part of the file.
+            end (int, optional): Offset after the last byte to upload, defaults to the end of the file.
+        """
+        name = name or os.path.basename(file_path)
+        boundary = uuid.uuid4().hex
+        fields = {'token': self.token, 'returnFormat': 'json', 'content': 'fileRepository', 'action': 'import', 'folder_id': folder_id}
+        head = "".join(f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n' for key, value in fields.items())
+        head += f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\nContent-Type: application/octet-stream\r\n\r\n'
+        head = head.encode("utf-8")
+        tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+        size = (os.path.getsize(file_path) if end is None else end) - start
+
+        async def body():
+            yield head
+            with open(file_path, "rb") as f:
+                f.seek(start)
+                sent = 0
+                while sent < size:
+                    chunk = await asyncio.to_thread(f.read, min(chunk_size, size - sent))
+                    if not chunk:
+                        break
+                    if limiter:
+                        await limiter.acquire(len(chunk))
+                    sent += len(chunk)
+                    yield chunk
+            yield tail
+
+        r = await self._post({'content': 'fileRepository'}, content=body(), headers={
+            'Content-Type': f'multipart/form-data; boundary={boundary}',
+            'Content-Length': str(len(head) + size + len(tail)),
+        })
+        print(r.text)
+
+    async def get_file(self, doc_id):
+        """Fetch a base64 encoded file from REDCAP given a document ID."""
+        r = await self._post({
+            'content': 'fileRepository',
+            'action': 'export',
+            'format': 'json',
+            'doc_id': doc_id,
+        })
+        return r.content
+
+    async def delete_document(self, doc_id):
+        """Delete a document from REDCAP given a document ID."""
+        r = await self._post({
+            'content': 'fileRepository',
+            'action': 'delete',
+            'doc_id': doc_id,
+        })
+        print(r)
+
+    async def delete_data(self, folder_id, concurrency=8, progress=None):
+        """Delete all documents in a folder. Returns the per-document results of delete_documents."""
+        files = await self.list_folders(folder_id)
+        return await self.delete_documents([file['doc_id'] for file in files if 'doc_id' in file], concurrency, progress)
+
+    async def delete_documents(self, doc_ids, concurrency=8, progress=None):
+        """
+        Delete several documents with at most `concurrency` requests in flight.
+        Returns one {"item", "ok", "error"} result per document, see _bulk.
+        """
+        return await self._bulk(doc_ids, self.delete_document, concurrency, progress)
+
+    async def upload_files(self, file_paths, patient_name, concurrency=4, progress=None):
+        """
+        Upload several files to a patient's folder with at most `concurrency` uploads in flight.
+        Returns one {"item", "ok", "error"} result per file, see _bulk.
+        """
+        folder_id = await self.folder_id(patient_name, create=True)
+        return await self._bulk(file_paths, lambda path: self.import_file(path, folder_id), concurrency, progress)
+
+    async def _bulk(self, items, operation, concurrency, progress=None):
+        """
+        Run an async operation over items with bounded concurrency. A failing item doesn't stop the others.
+        Args:
+            items (list): Items to pass to the operation.
+            operation (callable): Async function called with each item.
+            concurrency (int): Maximum number of operations running at once.
+            progress (callable, optional): Called as progress(done, total, result) after each item.
+        Returns:
+            list[dict]: {"item": item, "ok": bool, "error": str or None} for each item, in input order.
+        """
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        done = 0
+
+        async def run(item):
+            nonlocal done
+            async with semaphore:
+                try:
+                    await operation(item)
+                    result = {"item": item, "ok": True, "error": None}
+                except Exception as e:
+                    result = {"item": item, "ok": False, "error": str(e)}
+            done += 1
+            if progress:
+                progress(done, len(items), result)
+            return result
+
+        return await asyncio.gather(*(run(item) for item in items))
+
+    async def get_id_from_name(self, name):
+        """Get the folder ID from the folder name."""
+        return await self.folder_id(name)
+
+    async def list_records(self, records=[]):
+        """List all records in REDCAP."""
+        r = await self._post({
+            'content': 'record',
+            'format': 'json',
+            "records": records
+        })
+        return r.json()
+
+    async def get_record(self, record):
+        """
+        Get a single exported record, served from the cache while it is fresh.
+        Concurrent callers for the same record share one request. Returns None if the record doesn't exist.
+        """
+        record = str(record)
+        cached = self._records.get(record)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        if record not in self._pending:
+            self._pending[record] = asyncio.ensure_future(self._fetch_record(record))
+        return await asyncio.shield(self._pending[record])
+
+    async def _fetch_record(self, record):
+        try:
+            records = await self.list_records([record])
+            parsed = records[0] if records else None
+            self._records[record] = (time.monotonic() + self.ttl, parsed)
+            return parsed
+        finally:
+            del self._pending[record]
+
+    def invalidate(self, record=None):
+        """Drop a record from the cache, or every record when none is given."""
+        if record is None:
+            self._records.clear()
+        else:
+            self._records.pop(str(record), None)
+
+    async def get_screening_prettify(self, record):
+        """Get the screening view of a record, or None if the record doesn't exist."""
+        parsed = await self.get_record(record)
+        return prettify_screening(parsed) if parsed else None
+
+    async def get_patient_previsit(self, record):
+        """Get the previsit view of a record, or None if the record doesn't exist."""
+        parsed = await self.get_record(record)
+        return prettify_previsit(parsed) if parsed else None
+
+    async def get_patient_context(self, record):
+        """Get the patient context for the LLM, both views parsed from a single fetch of the record."""
+        return patient_context(await self.get_record(record))
 
 GENDER = {
     "1": "Man",
@@ -161,17 +331,8 @@ MEDICAL_PROBLEMS_LABELS = {
     "r_mp___6": "None of the above"
 }
 
-def get_screening_prettify(record):
-    """Get a record in a pretty format."""
-    data = {
-        'token': os.getenv("REDCAP"),
-        'content': 'record',
-        'format': 'json',
-        'returnFormat': 'json',
-        "records": [record]
-    }
-    r = requests.post(URL, data=data)
-    parsed = r.json()[0]
+def prettify_screening(parsed):
+    """Get the screening fields of an exported record in a pretty format."""
 
     races = []
 
@@ -247,17 +408,8 @@ BEHAVIORS_LABELSID = {
 }
 
 
-def get_patient_previsit(record):
-    """Get a record in a pretty format."""
-    data = {
-        'token': os.getenv("REDCAP"),
-        'content': 'record',
-        'format': 'json',
-        'returnFormat': 'json',
-        "records": [record]
-    }
-    r = requests.post(URL, data=data)
-    parsed = r.json()[0]
+def prettify_previsit(parsed):
+    """Get the previsit fields of an exported record in a pretty format."""
 
     behaviors = []
     for b in BEHAVIORS:
@@ -298,4 +450,13 @@ def get_patient_previsit(record):
 
     return filtered
 
-print(get_screening_prettify(1))
\ No newline at end of file
+
+def patient_context(parsed):
+    """Screening and previsit views of an exported record, each kept only if the instrument is complete."""
+    screening = prettify_screening(parsed) if parsed else None
+    previsit = prettify_previsit(parsed) if parsed else None
+
+    return {
+        "screening": screening if screening and screening["screening_complete"] == "2" else None,
+        "previsit": previsit if previsit and previsit["patient_previsit_complete"] == "2" else None
+    }
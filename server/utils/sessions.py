@@ -0,0 +1,109 @@
+import time
+
+from utils.context_store import SessionContext
+
+
+class Session:
+    """
+    State of one socket connection. The ASR state (online processor, audio queue, transcription task) only exists
+    while the session is recording, between start and stop.
+    """
+
+    def __init__(self, sid):
+        self.sid = sid
+        self.name = ""
+        self.online = None           # VACOnlineASRProcessor, created on start
+        self.asr_worker = None       # Index of the ASR worker the session is pinned to while recording
+        self.audio = None            # AudioIngress of PCM chunks waiting to be transcribed
+        self.audio_decoder = None    # Decodes the session's audio wire format to float32 PCM, picked on start
+        self.diarization = None      # DiartDiarization on the shared diarization service, when speaker labels are on
+        self.video = None            # VideoSegmenter of the visit's recording, created on the first video chunk
+        self.transcribe_task = None
+        self.chat_stream = None      # LLMStream of the answer being generated
+        self.patient_context = None  # asyncio task prefetching the patient's REDCap record
+        self.context = SessionContext()  # Transcript, emotions and chat history of the visit, for the LLM prompt
+        self.closed = False          # Set once the session is removed, its files are closed for good
+        self.created_at = time.monotonic()
+        self.last_active = self.created_at
+
+    @property
+    def recording(self):
+        return self.transcribe_task is not None
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def idle_seconds(self, now=None):
+        return (now or time.monotonic()) - self.last_active
+
+    def memory_bytes(self):
+        """Estimate of the memory held by the session, dominated by the audio buffers of the ASR state."""
+        total = 0
+        if self.online is not None:
+            # VACOnlineASRProcessor keeps its own VAD buffer and the buffer of the wrapped OnlineASRProcessor.
+            for processor in (self.online, getattr(self.online, "online", None)):
+                buffer = getattr(processor, "audio_buffer", None)
+                if buffer is not None:
+                    total += buffer.nbytes
+        if self.audio is not None:
+            total += self.audio.queued_samples * 4  # float32
+        return total
+
+
+class SessionRegistry:
+    """
+    Registry of the live socket sessions, replacing the per-sid dictionaries that were never cleaned up.
+    Sessions are created on first use and must be removed on disconnect, idle ones can be found with idle().
+    Args:
+        idle_timeout (float): Seconds without any event after which a session counts as idle.
+    """
+
+    def __init__(self, idle_timeout=3600.0):
+        self.idle_timeout = idle_timeout
+        self._sessions = {}
+
+    def get(self, sid):
+        """Get the session of a socket, creating it if needed, and mark it active."""
+        session = self._sessions.get(sid)
+        if session is None:
+            session = self._sessions[sid] = Session(sid)
+        session.touch()
+        return session
+
+    def remove(self, sid):
+        """Forget a session, returning it (or None) so the caller can release what it holds."""
+        return self._sessions.pop(sid, None)
+
+    def idle(self):
+        """Sids of the sessions idle for longer than idle_timeout."""
+        now = time.monotonic()
+        return [sid for sid, session in self._sessions.items() if session.idle_seconds(now) > self.idle_timeout]
+
+    def __contains__(self, sid):
+        return sid in self._sessions
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __iter__(self):
+        return iter(list(self._sessions.values()))
+
+    def stats(self):
+        """Live-session count and a per-session summary with memory estimates."""
+        now = time.monotonic()
+        sessions = {
+            sid: {
+                "name": session.name,
+                "recording": session.recording,
+                "asr_worker": session.asr_worker,
+                "memory_bytes": session.memory_bytes(),
+                "audio": session.audio.stats() if session.audio else None,
+                "idle_seconds": round(session.idle_seconds(now), 1),
+            }
+            for sid, session in self._sessions.items()
+        }
+        return {
+            "live_sessions": len(sessions),
+            "memory_bytes": sum(s["memory_bytes"] for s in sessions.values()),
+            "sessions": sessions,
+        }
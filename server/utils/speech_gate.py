@@ -0,0 +1,116 @@
+from bisect import bisect_right
+
+import numpy as np
+
+
+class SpeechGate:
+    """
+    Cheap energy gate in front of a session's VACOnlineASRProcessor, so silent stretches of a visit cost no inference.
+
+    Each batch of audio is cut into short frames and their energies compared, in one vectorized pass, to a noise floor
+    that follows the room: it drops at once to quieter audio and rises slowly, so steady background noise stops counting
+    as speech. Audio without speech is skipped, except for a hangover after speech so the VAC still sees the pause that
+    ends a sentence and commits it, and a short pre-roll kept to give the first word of the next utterance its onset.
+
+    Skipped audio never reaches the ASR, so the times it returns are on a shorter clock. to_recording_time() maps them
+    back to seconds from the start of recording.
+
+    The gate also sets the cadence of the transcription loop: the minimum new audio before the next inference is
+    min_interval while someone speaks, stretched when inference slows down (the session's real-time factor, which
+    includes waiting for its ASR batch, rises above target_rtf under load), and silence_interval during silence.
+
+    Args:
+        sample_rate (int): Sample rate of the PCM.
+        frame_seconds (float): Length of the frames whose energy is measured.
+        margin_db (float): How far above the noise floor a frame must be to count as speech.
+        threshold_db (float): Frames quieter than this (dBFS) never count as speech, whatever the floor.
+        min_speech (float): Seconds of speech frames needed for a batch to count as speech.
+        hangover (float): Seconds of audio still passed after the last speech, must cover the VAC's end-of-speech silence.
+        preroll (float): Seconds of the last skipped audio passed along with the next speech.
+        min_interval (float): Seconds of new audio between inferences during speech.
+        max_interval (float): Upper bound of the interval when inference falls behind.
+        silence_interval (float): Seconds of new audio between gate checks during silence.
+        target_rtf (float): Real-time factor above which the interval grows.
+    """
+
+    def __init__(self, sample_rate=16000, frame_seconds=0.02, margin_db=10.0, threshold_db=-50.0, min_speech=0.1,
+                 hangover=1.0, preroll=0.3, min_interval=0.5, max_interval=2.0, silence_interval=1.0, target_rtf=0.5):
+        self.sample_rate = sample_rate
+        self.frame = max(int(frame_seconds * sample_rate), 1)
+        self.margin_db = margin_db
+        self.threshold_db = threshold_db
+        self.min_speech_frames = max(int(min_speech / frame_seconds), 1)
+        self.hangover = int(hangover * sample_rate)
+        self.preroll = int(preroll * sample_rate)
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.silence_interval = max(silence_interval, min_interval)
+        self.target_rtf = target_rtf
+
+        self.noise_floor = None   # dBFS
+        self.rtf = 0.0            # Moving average of the session's real-time factor
+        self.since_speech = None  # Samples since the last speech, None before any
+        self.passed_samples = 0
+        self.skipped_samples = 0
+        self._gap_times = []      # ASR time in seconds at which each skipped stretch was jumped over
+        self._gap_skipped = []    # Recording seconds skipped before each of them
+        self._tail = np.zeros(0, dtype=np.float32)
+        self._skipping = False
+
+    def _speech_frames(self, pcm):
+        """Number of frames of pcm loud enough to be speech, updating the noise floor."""
+        n = len(pcm) // self.frame
+        if n == 0:
+            return 0
+        frames = pcm[:n * self.frame].reshape(n, self.frame)
+        db = 10 * np.log10(np.mean(np.square(frames, dtype=np.float32), axis=1) + 1e-10)
+
+        quiet = float(np.percentile(db, 10))
+        if self.noise_floor is None or quiet < self.noise_floor:
+            self.noise_floor = quiet
+        else:
+            self.noise_floor += 0.05 * (quiet - self.noise_floor)
+        return int(np.count_nonzero(db > max(self.noise_floor + self.margin_db, self.threshold_db)))
+
+    def gate(self, pcm):
+        """The audio to transcribe out of pcm: all of it (with the pre-roll in front after a skip), or None to skip it."""
+        if self._speech_frames(pcm) >= self.min_speech_frames:
+            self.since_speech = 0
+        elif self.since_speech is not None:
+            self.since_speech += len(pcm)
+
+        if self.since_speech is not None and self.since_speech - len(pcm) < self.hangover:
+            if self._skipping:
+                # The pre-roll goes to the ASR after all, the rest of the skipped audio is a jump of its clock.
+                self.skipped_samples -= len(self._tail)
+                self._gap_times.append(self.passed_samples / self.sample_rate)
+                self._gap_skipped.append(self.skipped_samples / self.sample_rate)
+                pcm = np.concatenate((self._tail, pcm))
+                self._tail = self._tail[:0]
+                self._skipping = False
+            self.passed_samples += len(pcm)
+            return pcm
+
+        self._skipping = True
+        self.skipped_samples += len(pcm)
+        if self.preroll:
+            self._tail = np.concatenate((self._tail, pcm))[-self.preroll:]
+        return None
+
+    def observe(self, elapsed, samples):
+        """Record the duration of an inference over samples of audio, for the cadence."""
+        if samples:
+            self.rtf += 0.3 * (elapsed / (samples / self.sample_rate) - self.rtf)
+
+    def interval(self):
+        """Seconds of new audio to wait for before the next inference."""
+        if self.since_speech is None or self.since_speech >= self.hangover:
+            return self.silence_interval
+        return min(self.min_interval * max(1.0, self.rtf / self.target_rtf), self.max_interval)
+
+    def to_recording_time(self, t):
+        """Seconds from the start of recording of a time returned by the ASR, given on the clock of the passed audio."""
+        if t is None:
+            return None
+        i = bisect_right(self._gap_times, t)
+        return t + (self._gap_skipped[i - 1] if i else 0.0)
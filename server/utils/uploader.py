@@ -0,0 +1,214 @@
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Journal of each session's uploads, in the session folder next to the files.
+JOURNAL = "uploads.jsonl"
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all uploads, so together they stay under a bandwidth cap and leave room for the live streams.
+    Args:
+        rate (float): Bytes per second, 0 for no limit.
+        burst (float, optional): Bytes that can go at once after an idle period, defaults to one second of rate.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, n):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= n
+            if self._tokens < 0:
+                # Borrow what is missing and wait until it has been earned back.
+                await asyncio.sleep(-self._tokens / self.rate)
+
+
+class RedcapUploader:
+    """
+    Uploads session files to the patient's folder of the REDCap file repository in the background, while the visit goes on.
+
+    Files are queued once they are complete (a closed video segment, the logs at the end of a visit) and streamed from
+    disk by a few workers under a shared bandwidth cap. A failed upload is retried with exponential backoff without
+    holding up the other files. The REDCap API has no partial uploads, so uploads resume per file: every queued and
+    every finished upload is recorded in the session's journal, and resume() queues again the files a previous run
+    did not finish. Append-only logs are queued again whenever a visit of the session ends, e.g. also on a page reload,
+    and only the bytes added since their last upload are sent, as the next part "<name>_part<n><ext>", so REDCap never
+    gets two copies of the same lines. Journal lines are appended by a thread of their own with the file opened, synced and closed each
+    time, so no handle outlives the session's files and the last lines are on disk when the visit ends.
+
+    Args:
+        redcap (RedcapClient): Client used for the uploads.
+        artifacts (ArtifactWriter): Writer of the session files, for their paths.
+        rate (float): Bandwidth cap in bytes per second for all uploads together, 0 for no limit.
+        retries (int): Attempts of a file before it is left to the next resume().
+        backoff (float): Seconds before the first retry, doubled for each further one.
+        workers (int): Uploads in flight at once.
+    """
+
+    def __init__(self, redcap, artifacts, rate=2_000_000, retries=5, backoff=2.0, workers=2):
+        self.redcap = redcap
+        self.artifacts = artifacts
+        self.limiter = RateLimiter(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.workers = workers
+        self.stats = {"queued": 0, "uploaded": 0, "skipped": 0, "failed": 0, "retried": 0, "bytes": 0}
+        self._queue = asyncio.Queue()
+        self._tasks = []
+        self._retrying = set()
+        self._parts = {}  # (session, filename) -> (parts uploaded, bytes uploaded) of each append-only log
+        self._locks = {}  # (session, filename) -> Lock, one upload of an append-only log at a time
+        # One thread keeps the journal lines in order.
+        self._journal_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="upload-journal")
+
+    def start(self):
+        """Start the workers, call from the running event loop."""
+        self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for handle in self._retrying:
+            handle.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await asyncio.get_running_loop().run_in_executor(None, self._journal_executor.shutdown)
+
+    def pending(self):
+        """Files queued or waiting for a retry."""
+        return self._queue.qsize() + len(self._retrying)
+
+    def enqueue(self, session, filename, ready=None, append=False):
+        """
+        Queue a session file for upload.
+        Args:
+            session (str): Session name, the patient's record ID.
+            filename (str): File in the session folder.
+            ready (Future, optional): Future of the ArtifactWriter resolved once the file is complete on disk.
+            append (bool): The file is an append-only log, only what was added since its last upload is uploaded.
+        """
+        self._journal(session, filename, "queued", append=append)
+        self.stats["queued"] += 1
+        self._queue.put_nowait((session, filename, ready, 0, append))
+
+    def resume(self):
+        """Queue again the files a previous run queued but didn't upload. Call once at startup."""
+        root = self.artifacts.root
+        if not os.path.isdir(root):
+            return
+        for session in os.listdir(root):
+            journal = os.path.join(root, session, JOURNAL)
+            if not os.path.isfile(journal):
+                continue
+            states = {}
+            appends = set()
+            with open(journal, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Last line cut short by a crash
+                    states[entry["file"]] = entry["state"]
+                    if entry.get("append"):
+                        appends.add(entry["file"])
+                    if "part" in entry:
+                        self._parts[(session, entry["file"])] = (entry["part"], entry["bytes"])
+            for filename, state in states.items():
+                if state != "uploaded":
+                    print(f"Resuming upload of {filename} for session {session}")
+                    self.stats["queued"] += 1
+                    self._queue.put_nowait((session, filename, None, 0, filename in appends))
+
+    def _journal(self, session, filename, state, **fields):
+        line = json.dumps({"file": filename, "state": state, **fields, "time": time.time()}) + "\n"
+        self._journal_executor.submit(self._append, self.artifacts.path(session, JOURNAL), line)
+
+    @staticmethod
+    def _append(path, line):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as e:
+            print(f"Error writing upload journal {path}: {e}")
+
+    async def _work(self):
+        while True:
+            session, filename, ready, attempt, append = await self._queue.get()
+            try:
+                if ready is not None:
+                    await asyncio.wrap_future(ready)
+                if append:
+                    await self._upload_part(session, filename)
+                else:
+                    await self._upload(session, filename)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._retry(session, filename, attempt, e, append)
+
+    async def _upload(self, session, filename):
+        path = self.artifacts.path(session, filename)
+        if not os.path.exists(path):
+            # Nothing was written, e.g. a visit without chat has no chat log.
+            self._journal(session, filename, "uploaded")
+            self.stats["skipped"] += 1
+            return
+        folder_id = await self.redcap.folder_id(session, create=True)
+        await self.redcap.import_file(path, folder_id, limiter=self.limiter)
+        self._journal(session, filename, "uploaded")
+        self.stats["uploaded"] += 1
+        self.stats["bytes"] += os.path.getsize(path)
+
+    async def _upload_part(self, session, filename):
+        """Upload what was added to an append-only log since its last upload, as its next part."""
+        key = (session, filename)
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            path = self.artifacts.path(session, filename)
+            parts, start = self._parts.get(key, (0, 0))
+            end = os.path.getsize(path) if os.path.exists(path) else 0
+            if end <= start:
+                # Nothing was added since the last upload, e.g. a page reload without new lines.
+                self._journal(session, filename, "uploaded", append=True, part=parts, bytes=start)
+                self.stats["skipped"] += 1
+                return
+            root, ext = os.path.splitext(filename)
+            name = f"{root}_part{parts + 1}{ext}" if parts else filename
+            folder_id = await self.redcap.folder_id(session, create=True)
+            await self.redcap.import_file(path, folder_id, name=name, limiter=self.limiter, start=start, end=end)
+            self._parts[key] = (parts + 1, end)
+            self._journal(session, filename, "uploaded", append=True, part=parts + 1, bytes=end)
+            self.stats["uploaded"] += 1
+            self.stats["bytes"] += end - start
+
+    def _retry(self, session, filename, attempt, error, append=False):
+        attempt += 1
+        if attempt >= self.retries:
+            print(f"Giving up uploading {filename} for session {session} after {attempt} attempts: {error}")
+            self.stats["failed"] += 1
+            return
+
+        delay = self.backoff * 2 ** (attempt - 1)
+        print(f"Upload of {filename} for session {session} failed ({error}), retrying in {delay:.0f}s")
+        self.stats["retried"] += 1
+
+        def requeue():
+            self._retrying.discard(handle)
+            self._queue.put_nowait((session, filename, None, attempt, append))
+
+        handle = asyncio.get_running_loop().call_later(delay, requeue)
+        self._retrying.add(handle)
@@ -0,0 +1,150 @@
+import json
+import time
+
+# EBML ID of a WebM Cluster, the unit of media data a segment can start at, and of the Timecode opening every Cluster.
+CLUSTER_ID = b"\x1f\x43\xb6\x75"
+TIMECODE_ID = 0xE7
+MANIFEST = "video_manifest.jsonl"
+
+
+def _vint(data, pos):
+    """(length, value) of the EBML variable size integer at pos, None if it is invalid or cut off."""
+    if pos >= len(data) or data[pos] == 0:
+        return None
+    length = 9 - data[pos].bit_length()
+    if pos + length > len(data):
+        return None
+    value = data[pos] & (0xFF >> length)
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+    return length, value
+
+
+def _is_cluster(data, i):
+    """Whether the Cluster ID at i starts an element: it must be followed by a valid size, then the Cluster's Timecode."""
+    size = _vint(data, i + len(CLUSTER_ID))
+    if size is None:
+        return False
+    pos = i + len(CLUSTER_ID) + size[0]
+    if pos >= len(data) or data[pos] != TIMECODE_ID:
+        return False
+    timecode = _vint(data, pos + 1)
+    return timecode is not None and 1 <= timecode[1] <= 8 and pos + 1 + timecode[0] + timecode[1] <= len(data)
+
+
+def find_cluster(data, start=0):
+    """
+    Offset of the first Cluster element in a chunk, or -1. The ID bytes can also occur inside frame data, a match only
+    counts when followed by a Cluster size and Timecode element, a Cluster cut off by the end of the chunk isn't found.
+    """
+    i = data.find(CLUSTER_ID, start)
+    while i >= 0 and not _is_cluster(data, i):
+        i = data.find(CLUSTER_ID, i + 1)
+    return i
+
+
+class VideoSegmenter:
+    """
+    Splits the WebM stream of a session's MediaRecorder into segment files of about segment_seconds, instead of one file
+    growing for the whole visit, so each completed segment can be uploaded while the visit goes on.
+
+    Only the first chunk of a recording holds the WebM header (EBML header and track descriptions). It is kept as the
+    init chunk and written at the start of every later segment, which starts at a Cluster, so each segment plays on its
+    own. Rotation waits for a chunk holding a Cluster start, MediaRecorder opens one every few seconds.
+    Each completed segment is closed through the ArtifactWriter and recorded as a line of the session's manifest.
+    A recording can start before the visit is named, move_to() then takes its files to the visit's folder.
+
+    Args:
+        artifacts (ArtifactWriter): Writer of the session files.
+        session (str): Session name, the folder of the files.
+        prefix (str): Segment file names are "<prefix>_<index>.webm".
+        segment_seconds (float): Duration after which the next Cluster starts a new segment.
+        on_segment (callable, optional): Called with (session, filename, future) when a segment is complete in a session's
+            folder, the Future of the ArtifactWriter resolves once the file is there and closed.
+    """
+
+    def __init__(self, artifacts, session, prefix, segment_seconds=60.0, on_segment=None):
+        self.artifacts = artifacts
+        self.session = session
+        self.prefix = prefix
+        self.segment_seconds = segment_seconds
+        self.on_segment = on_segment
+        self.index = -1
+        self._init = None     # Header of the current recording, None between recordings
+        self._completed = []  # Segments completed in the current folder
+        self._filename = None
+        self._started = None  # time.time() the current segment started
+        self._bytes = 0
+
+    def add(self, data):
+        """Append a MediaRecorder chunk, rotating to the next segment once the current one is long enough."""
+        if self._init is None:
+            # The first chunk of a recording: everything before its first Cluster is the header.
+            i = find_cluster(data)
+            self._init = data[:i] if i > 0 else data
+            self._open()
+        elif self._filename is None:
+            # The last segment was completed by move_to(), the next one starts at a Cluster, what comes before is lost.
+            i = find_cluster(data)
+            if i < 0:
+                return
+            self._open()
+            self._write(self._init)
+            data = data[i:]
+        elif time.time() - self._started >= self.segment_seconds:
+            i = find_cluster(data)
+            if i >= 0:
+                if i:
+                    self._write(data[:i])
+                self._close()
+                self._open()
+                self._write(self._init)
+                data = data[i:]
+        self._write(data)
+
+    def move_to(self, session):
+        """
+        Continue the recording in another session's folder. The files of an unnamed session move along with it and its
+        completed segments are reported then, a named session's current segment is completed where it is.
+        """
+        if session == self.session:
+            return
+        if not self.session:
+            for filename in self._completed + [MANIFEST] + ([self._filename] if self._filename else []):
+                moved = self.artifacts.move(self.session, filename, session)
+                if filename in self._completed and self.on_segment:
+                    self.on_segment(session, filename, moved)
+        elif self._filename is not None:
+            self._close()
+        self.session = session
+        self._completed = []
+
+    def finish(self):
+        """Complete the current segment when the recording stops. The next chunk added starts a new recording."""
+        if self._filename is not None:
+            self._close()
+        self._init = None
+
+    def _open(self):
+        self.index += 1
+        self._filename = f"{self.prefix}_{self.index:04d}.webm"
+        self._started = time.time()
+        self._bytes = 0
+
+    def _write(self, data):
+        self.artifacts.write(self.session, self._filename, data)
+        self._bytes += len(data)
+
+    def _close(self):
+        filename, self._filename = self._filename, None
+        closed = self.artifacts.close_file(self.session, filename)
+        self.artifacts.write(self.session, MANIFEST, json.dumps({
+            "file": filename,
+            "index": self.index,
+            "start": self._started,
+            "end": time.time(),
+            "bytes": self._bytes,
+        }) + "\n")
+        self._completed.append(filename)
+        if self.on_segment:
+            self.on_segment(self.session, filename, closed)